@@ -29,6 +29,8 @@ if [ -d "$1" ]; then
 	cp -a "$1" "$T/"
 	mv $T/$ANAME $T/assignment
 	realpath "$1" > $T/upstream
+	# pin the built revision, so grading runs don't fetch (see update_assignment.sh)
+	git -C "$1" rev-parse HEAD > $T/assignment_rev
 	date > $T/build_timestamp
 
 	if [ ! -z "$2" ]; then
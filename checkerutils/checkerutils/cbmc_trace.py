@@ -14,11 +14,180 @@
 #
 
 import json
-import argparse
 import os
 import sys
 
+class JSONStream(object):
+    """Incremental reader for a JSON document.
+
+       Arrays and objects can be walked element by element with
+       array() and object(), so that only parts of a large document
+       are held in memory. Other values are decoded whole by value()."""
+
+    CHUNK = 1024*1024
+
+    def __init__(self, f, name = None):
+        self.f = f
+        self.name = name
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size = None):
+        if self.eof:
+            return False
+
+        data = self.f.read(size or self.CHUNK)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _error(self, msg):
+        return json.JSONDecodeError(msg, self.buf, self.pos)
+
+    def peek(self):
+        """Return the next non-whitespace character, '' at the end"""
+
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos+1]
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise self._error(f"Expecting '{c}'")
+
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may be incomplete
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return v
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self._fill(max(self.CHUNK, len(self.buf)))
+
+    def _items(self, close):
+        c = self.peek()
+        if c == ',':
+            self.pos += 1
+            return True
+        elif c == close:
+            self.pos += 1
+            return False
+        else:
+            raise self._error(f"Expecting ',' or '{close}'")
+
+    def array(self):
+        """Generator that yields before each element of an array, which
+           the caller must then read."""
+
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield
+            if not self._items(']'): return
+
+    def values(self):
+        """Generator over the elements of an array"""
+
+        for _ in self.array():
+            yield self.value()
+
+    def object(self):
+        """Generator that yields each key of an object, whose value
+           the caller must then read."""
+
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            if self.peek() != '"':
+                raise self._error("Expecting property name enclosed in double quotes")
+
+            k = self.value()
+            self.expect(':')
+            yield k
+            if not self._items('}'): return
+
+def iter_cbmc_json(f, process_trace = None):
+    """Iterate over the messages in CBMC --json-ui output, without
+       loading the whole document.
+
+       process_trace is called with an iterator over the steps of each
+       trace, and its return value replaces the trace (if it returns
+       None, the trace is dropped). By default, traces are kept whole."""
+
+    s = JSONStream(f)
+    for _ in s.array():
+        if s.peek() != '{':
+            yield s.value()
+            continue
+
+        obj = {}
+        for k in s.object():
+            if k != 'result' or s.peek() != '[':
+                obj[k] = s.value()
+                continue
+
+            results = []
+            for _ in s.array():
+                if s.peek() != '{':
+                    results.append(s.value())
+                    continue
+
+                r = {}
+                for rk in s.object():
+                    if rk == 'trace' and s.peek() == '[':
+                        steps = s.values()
+                        t = process_trace(steps) if process_trace else list(steps)
+                        for _ in steps: pass # skip whatever was not consumed
+
+                        if t is not None: r['trace'] = t
+                    else:
+                        r[rk] = s.value()
+
+                results.append(r)
+
+            obj[k] = results
+
+        yield obj
+
+_record_locations = {}
+
 def get_record_locations(srcfile):
+    """Return the lines marked //@record in srcfile, by function.
+
+       Results are memoized for as long as srcfile is unchanged, and
+       must not be modified."""
+
+    st = os.stat(srcfile)
+    k = (os.path.realpath(srcfile), st.st_mtime_ns, st.st_size)
+    if k not in _record_locations:
+        _record_locations[k] = _get_record_locations(srcfile)
+
+    return _record_locations[k]
+
+def _get_record_locations(srcfile):
     lines={}
     func = None
 
@@ -41,22 +210,38 @@ def get_record_locations(srcfile):
     return lines
 
 class CBMCTrace(object):
-    def __init__(self, jsond = None, jsonfile = None):
+    def __init__(self, jsond = None, jsonfile = None, traces = True, process_trace = None):
+        """Read CBMC JSON output from jsond or jsonfile.
+
+           When reading jsonfile, the output is streamed. Traces are
+           only kept if traces is True, or passed through
+           process_trace (see iter_cbmc_json) if it is provided."""
+
         assert jsond or jsonfile, "Must provide either json or jsonfile"
         assert jsond is None or jsonfile is None, "Must not provide both json or jsonfile"
 
         if jsond:
             self.json = jsond
         else:
-            with open(jsonfile, "rb") as f:
+            if process_trace is None and not traces:
+                process_trace = lambda steps: None
+
+            self.json = []
+            with open(jsonfile, "r", encoding="utf-8") as f:
                 try:
-                    self.json = json.load(f)
-                except json.JSONDecodeError as e:
+                    for x in iter_cbmc_json(f, process_trace):
+                        self.json.append(x)
+                except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                    if isinstance(e, json.JSONDecodeError):
+                        where = f"[char {e.pos} of buffer] "
+                    else:
+                        where = ""
+
                     errmsg_dict = {
                                     "messageType": "ERROR",
-                                    "messageText": f"[line {e.lineno} column {e.colno} (char {e.pos})] Failed to read {e.doc} as JSON\n {e.msg}"
+                                    "messageText": f"{where}Failed to read {jsonfile} as JSON\n {e}"
                                 }
-                    self.json = json.JSONEncoder().encode(errmsg_dict)
+                    self.json.append(errmsg_dict)
 
         self._result = None
 
@@ -95,17 +280,96 @@ class CBMCTrace(object):
 
         return out
 
-def get_trace(jsonfile, srcfile):
-    with open(jsonfile, "rb") as f:
-        j = json.load(f)
+def get_record_index(record_fn):
+    """Return a function -> set of recorded lines lookup for the output
+       of get_record_locations. Lines are included both as integers and
+       as strings, as CBMC reports them, to avoid conversions."""
+
+    return {fn: lines | {str(l) for l in lines} for fn, lines in record_fn.items()}
+
+def filter_trace(steps, record_fn, srcfile, rows = None):
+    """Return the recorded assignments in trace steps, as a list of
+       variables in order of first assignment, and a dictionary of
+       their last values.
+
+       If rows is a list, every recorded assignment is also appended to
+       it as a (step index, lhs, value, binary) tuple.
+
+       Only the steps needed to track the call stack are examined in
+       functions that have no recorded lines."""
+
+    index = get_record_index(record_fn)
+
+    stack = []
+    lines = None # recorded lines of current function, None if none
+    data = {}
+    order = []
+
+    for i, t in enumerate(steps):
+        if t['hidden']:
+            continue
+
+        st = t['stepType']
+        if st == 'assignment':
+            if lines is None or t['assignmentType'] != 'variable':
+                continue
+
+            loc = t.get('sourceLocation', None)
+            if loc is None or loc['line'] not in lines or loc['file'] != srcfile:
+                continue
+
+            lhs = t['lhs']
+            if lhs not in data:
+                order.append(lhs)
+
+            v = t['value']
+            if 'data' in v:
+                data[lhs] = (v['data'], v['binary'])
+            else:
+                data[lhs] = v
+
+            if rows is not None:
+                if 'data' in v:
+                    rows.append((i, lhs, v['data'], v['binary']))
+                else:
+                    rows.append((i, lhs, json.dumps(v), ''))
+        elif st == 'function-call':
+            stack.append(lines)
+            lines = index.get(t['function']['displayName'], None)
+        elif st == 'function-return':
+            lines = stack.pop() if stack else None
+
+    return order, data
+
+def open_trace(jsonfile, srcfile, rows = False):
+    """Read CBMC JSON output, keeping only the recorded assignments in
+       each trace. The result can be used both as a CBMCTrace and with
+       trace_to_results.
+
+       If rows is True, every recorded assignment is also kept for
+       write_counterexamples."""
 
     record_fn = get_record_locations(srcfile)
 
     if len(record_fn) == 0:
         print(f"WARNING: No //@begin and //@record found in {srcfile}", file=sys.stderr)
 
+    # only the recorded assignments of each trace are kept in memory
+    def process_trace(steps):
+        r = [] if rows else None
+        order, data = filter_trace(steps, record_fn, srcfile, r)
+        return order, data, r
+
+    return CBMCTrace(jsonfile=jsonfile, process_trace=process_trace)
+
+def get_trace(jsonfile, srcfile):
+    return trace_to_results(open_trace(jsonfile, srcfile))
+
+def trace_to_results(ct):
+    """Convert a CBMCTrace produced by open_trace to a list of results
+       with counterexamples."""
+
     out = []
-    ct = CBMCTrace(j)
     for r in ct.get_results():
         test = {'property': r['property'],
                 'description': r['description'],
@@ -113,45 +377,10 @@ def get_trace(jsonfile, srcfile):
                 }
 
         if r['status'] == "FAILURE":
-            function_depth = 0
-            function = []
-            data = {}
-            order = []
-
             if not 'trace' in r:
                 continue
 
-            for t in r['trace']:
-                if t['hidden']:
-                    continue
-
-                if t['stepType'] == 'function-call':
-                    function_depth += 1
-                    function.append(t['function']['displayName'])
-
-                if t['stepType'] == 'assignment' and t['assignmentType'] == 'variable':
-                    show = False
-                    if 'sourceLocation' in t and function[-1] in record_fn:
-                        if t['sourceLocation']['file'] == srcfile:
-                            if int(t['sourceLocation']['line']) in record_fn[function[-1]]:
-                                show=True
-                                ln = t['sourceLocation']['line']
-
-                    if show:
-                        if t['lhs'] not in data:
-                            order.append(t['lhs'])
-
-                        if 'data' in t['value']:
-                            data[t['lhs']] = (t['value']['data'], t['value']['binary'])
-                            #print(ln, t['lhs'], t['value']['data'])
-                        else:
-                            data[t['lhs']] = t['value']
-                            #print(ln, t['lhs'], t['value'])
-
-                if t['stepType'] == 'function-return':
-                    function_depth -= 1
-                    function.pop()
-
+            order, data, _ = r['trace']
             counter_example = "\n".join([f"\t{k} = {data[k][0]} ({data[k][1]})" for k in order])
             test['output'] = counter_example
 
@@ -159,25 +388,55 @@ def get_trace(jsonfile, srcfile):
 
     return out
 
+# columns of the counterexample export
+COUNTEREXAMPLE_FIELDS = ['submission', 'test', 'property', 'step', 'lhs', 'value', 'binary']
+
+def write_counterexamples(ct, csvfile, test = '', submission = ''):
+    """Append the recorded assignments of each failed property in ct (a
+       CBMCTrace produced by open_trace with rows = True) to csvfile,
+       one row per assignment, tagged with the submission id and test
+       name. The header is written if csvfile is new.
+
+       Rows can be loaded in bulk (e.g. with csv, sqlite3 or pandas)
+       across many submissions."""
+
+    new = not os.path.exists(csvfile) or os.path.getsize(csvfile) == 0
+
+    out = []
+    for r in ct.get_results(assert_on_missing=False):
+        if 'trace' not in r or r['trace'][2] is None:
+            continue
+
+        for step, lhs, value, binary in r['trace'][2]:
+            out.append((submission, test, r['property'], step, lhs, value, binary))
+
+    import csv
+
+    with open(csvfile, "a", newline='') as f:
+        w = csv.writer(f)
+        if new: w.writerow(COUNTEREXAMPLE_FIELDS)
+        w.writerows(out)
+
 if __name__ == "__main__":
+    import argparse
+
     p = argparse.ArgumentParser(description="Parse CBMC JSON output")
 
     p.add_argument("jsonfile", help="JSON File")
     p.add_argument("srcfile", help="Source file for checker File")
     p.add_argument("outputjson", help="Output file containing results")
+    p.add_argument("--counterexamples", help="Append recorded assignments of counterexamples to this CSV file")
+    p.add_argument("--submission", default='', help="Submission id for the counterexamples CSV")
 
     args = p.parse_args()
 
-    with open(args.jsonfile, "rb") as f:
-        j = json.load(f)
-
-    record_fn = get_record_locations(args.srcfile)
-
-    if len(record_fn) == 0:
-        print(f"WARNING: No //@begin and //@record found in {args.srcfile}", file=sys.stderr)
-
     srcfile = args.srcfile
-    out = get_trace(args.jsonfile, srcfile)
+    ct = open_trace(args.jsonfile, srcfile, rows = args.counterexamples is not None)
+    out = trace_to_results(ct)
+
+    if args.counterexamples:
+        write_counterexamples(ct, args.counterexamples, os.path.basename(args.jsonfile),
+                              args.submission)
 
     with open(args.outputjson, "w") as f:
         f.write(json.dumps(out, indent=4))
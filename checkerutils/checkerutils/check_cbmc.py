@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 
 from __future__ import print_function
-import argparse
-import yaml
 import sys
-import pycparser
-from pycparser import c_generator, c_ast
 import os
 import tempfile
 import subprocess
-import cxform
+import json
+import functools
+import hashlib
+import importlib
+import time
+from collections import namedtuple
 
+# yaml, pycparser, cxform and cbmc_trace are imported when first needed,
+# so that importing this module (e.g., for check_cbmc()) is cheap
+
+def _sibling(name):
+    """Import module name from the same directory, whether this is run
+       as a script or imported from checkerutils"""
+
+    if __package__:
+        return importlib.import_module(f"{__package__}.{name}")
+
+    return importlib.import_module(name)
+
+class CPPError(Exception):
+    """The C preprocessor failed"""
+    pass
 
 def preprocess_c(c_code):
     p = subprocess.Popen(["cpp", "-E"], stdin=subprocess.PIPE,
@@ -22,38 +38,177 @@ def preprocess_c(c_code):
     if p.returncode == 0:
         return stdout.decode('utf-8')
     else:
-        print("ERROR: preprocessor failed.\n", file=sys.stderr)
-        print(stderr, file=sys.stderr)
-        sys.exit(1)
+        raise CPPError(stderr.decode('utf-8', errors='replace'))
+
+
+SNIPPET_FN = "__gsag_snippet_"
+
+def parse_snippets(snippets):
+    """Preprocess and parse several snippets of C statements at once,
+       returning a list of the statements in each snippet."""
+
+    import pycparser
+
+    code = []
+    for i, c in enumerate(snippets):
+        code.append(f"void {SNIPPET_FN}{i}() {{\n{c}\n}}")
+
+    p = pycparser.c_parser.CParser()
+    ast = p.parse(preprocess_c("\n".join(code)), filename="<insert.c>")
 
+    out = {}
+    for tl in ast.ext:
+        if isinstance(tl, pycparser.c_ast.FuncDef) and tl.decl.name.startswith(SNIPPET_FN):
+            out[int(tl.decl.name[len(SNIPPET_FN):])] = tl.body.block_items or []
+
+    return [out[i] for i in range(len(snippets))]
 
 class CodeEditor(object):
     def __init__(self, ccode, cfilename):
         self.ccode = ccode
         self.cfilename = cfilename
 
+        import pycparser
         p = pycparser.c_parser.CParser()
         self.ast = p.parse(preprocess_c(ccode), filename=self.cfilename)
 
-    def insert_at_fn_exit(self, fn_name, code):
-        p = pycparser.c_parser.CParser()
-        code = "void anon() {" + preprocess_c(code) + "}"
-        code_ast = p.parse(code, filename="<insert.c>")
-        code_ast = code_ast.ext[0].body.block_items
+    def insert_at_fn_exit(self, fn_name, code = None, code_ast = None):
+        """Insert code (or its already parsed statements, code_ast) at the
+           lexical exit of function fn_name."""
+
+        import pycparser
+
+        if code_ast is None:
+            code_ast = parse_snippets([code])[0]
 
         for tl in self.ast.ext:
             if isinstance(tl, pycparser.c_ast.FuncDef) and tl.decl.name == fn_name:
+                if tl.body.block_items is None:
+                    tl.body.block_items = []
+
                 tl.body.block_items.extend(code_ast)
 
     def output(self):
+        from pycparser import c_generator
+
         c_gen = c_generator.CGenerator()
         self.ccode = c_gen.visit(self.ast)
 
         return self.ccode
 
+@functools.lru_cache(maxsize=None)
+def cbmc_version():
+    return subprocess.check_output(["cbmc", "--version"]).strip()
+
+class CBMCCache(object):
+    """Content-addressed cache of CBMC output on local disk.
+
+       Entries are keyed by a hash of the input file's contents, the
+       CBMC command line (without the input file name) and the CBMC
+       version. The input file name is replaced by a placeholder in
+       the stored output, so entries are independent of the temporary
+       file they were produced from.
+
+       When the cache grows beyond max_size bytes, the least recently
+       used entries are removed.
+
+       Only CBMC's verification outcomes are cached, so that a transient
+       failure (e.g. being killed when out of memory) is not replayed."""
+
+    PLACEHOLDER = b"@@CBMC_INPUT_FILE@@"
+    RETURNCODES = (0, 10) # verification successful, verification failed
+
+    def __init__(self, cachedir, max_size = 512*1024*1024):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def key(self, cmdline):
+        inputfile = cmdline[1]
+
+        h = hashlib.sha256()
+        h.update(cbmc_version() + b"\0")
+        h.update("\0".join(cmdline[2:]).encode('utf-8') + b"\0")
+        with open(inputfile, "rb") as f:
+            h.update(f.read())
+
+        return h.hexdigest()
+
+    def get(self, cmdline, out = None):
+        fn = os.path.join(self.cachedir, self.key(cmdline))
+        try:
+            with open(fn, "rb") as f:
+                returncode = int(f.readline())
+                output = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            os.utime(fn) # for LRU
+        except FileNotFoundError: # concurrent eviction
+            pass
+
+        print(f"INFO: Using cached CBMC output {fn}", file=out)
+        return returncode, output.replace(self.PLACEHOLDER, cmdline[1].encode('utf-8'))
+
+    def put(self, cmdline, returncode, output):
+        if returncode not in self.RETURNCODES:
+            return
+
+        fn = os.path.join(self.cachedir, self.key(cmdline))
+        h, tmp = tempfile.mkstemp(dir=self.cachedir, prefix=".tmp")
+        with os.fdopen(h, "wb") as f:
+            f.write(b"%d\n" % (returncode,))
+            f.write(output.replace(cmdline[1].encode('utf-8'), self.PLACEHOLDER))
+
+        os.replace(tmp, fn)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for e in os.scandir(self.cachedir):
+            if e.is_file() and not e.name.startswith("."):
+                try:
+                    st = e.stat()
+                except FileNotFoundError: # concurrent eviction
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError: # concurrent eviction
+                pass
+
+            total -= size
+
+# options of check_cbmc, see the command line arguments below
+Options = namedtuple('OPTIONS', 'keep json_ui output quiet jobs property_timeout cache cache_size timeout_s',
+                     defaults=(False, False, None, False, 1, None, None, 512, None))
+
 class Preprocessor(object):
-    def __init__(self, ppfile):
+    cache = None # a CBMCCache
+    deadline = None # time.monotonic() by which all CBMC runs must end
+    timed_out = False # set when a CBMC run was killed by the deadline
+
+    def __init__(self, ppfile, options = None, out = None, err = None):
+        """options are Options (or the parsed command line arguments).
+           Messages are printed to out and err (default sys.stdout and
+           sys.stderr)."""
+
+        import yaml
+
         self.ppfile = ppfile
+        self.options = options or Options()
+        self.out = out or sys.stdout
+        self.err = err or sys.stderr
         self._preprocessed = False
 
         with open(self.ppfile, "r") as f:
@@ -66,74 +221,79 @@ class Preprocessor(object):
 
         self.cprocessed = self.cinput
 
-    def apply_transformers(self):
+    def apply_transformers(self, ce):
         if 'transformers' in self.pp:
+            cxform = _sibling('cxform')
             xformers = []
             for x in self.pp['transformers']:
                 if x['name'] == 'PrintfTransformer':
-                    print("INFO: Adding PrintfTransformer", file=sys.stderr)
+                    print("INFO: Adding PrintfTransformer", file=self.err)
                     xformers.append(cxform.PrintfTransformer())
                 elif x['name'] == 'PostconditionTransformer':
-                    print(f"INFO: Adding {x['name']}", file=sys.stderr)
+                    print(f"INFO: Adding {x['name']}", file=self.err)
                     xformers.append(cxform.PostconditionTransformer(x))
                 elif x['name'] == 'PreconditionTransformer':
-                    print(f"INFO: Adding {x['name']}", file=sys.stderr)
+                    print(f"INFO: Adding {x['name']}", file=self.err)
                     xformers.append(cxform.PreconditionTransformer(x))
                 else:
                     assert False, "Unknown transformer: '%s'" % (x['name'],)
 
-            print("INFO: Transforming code", file=sys.stderr)
+            print("INFO: Transforming code", file=self.err)
             att = cxform.ASTTransformer(xformers)
-            self.cprocessed = att.transform_string(self.cprocessed)
+            ce.ast = att.transform_ast(ce.ast)
 
-    def apply_insert_at_exit(self):
+    def apply_insert_at_exit(self, ce):
         if 'insert_at_exit' in self.pp:
+            # preprocess and parse all snippets at once
+            snippets = parse_snippets([e['code'] for e in self.pp['insert_at_exit']])
 
-            ce = CodeEditor(self.cprocessed, self.cinputfile)
-
-            for e in self.pp['insert_at_exit']: # lexical exit
-                code = e['code']
+            for e, code_ast in zip(self.pp['insert_at_exit'], snippets): # lexical exit
                 fn = e['function_name']
-                print("INFO: Processed insert_at_exit for '%s' function" % (fn,), file=sys.stderr)
-
-                ce.insert_at_fn_exit(fn, code)
+                print("INFO: Processed insert_at_exit for '%s' function" % (fn,), file=self.err)
 
-            self.cprocessed = ce.output()
+                ce.insert_at_fn_exit(fn, code_ast = code_ast)
         else:
-            print("INFO: No insert_at_exit section found in %s" % (self.ppfile,), file=sys.stderr)
+            print("INFO: No insert_at_exit section found in %s" % (self.ppfile,), file=self.err)
 
     def apply_templates(self):
         if 'template' in self.pp:
             pre = self.pp['template'].get('pre', '').strip()
             if pre:
-                print("INFO: Applying pre template section", file=sys.stderr)
+                print("INFO: Applying pre template section", file=self.err)
                 pre += "\n\n"
             else:
                 pre = "/* empty pre */\n\n"
 
             post = self.pp['template'].get('post', '')
             if post:
-                print("INFO: Applying post template section", file=sys.stderr)
+                print("INFO: Applying post template section", file=self.err)
                 post = "\n\n" + post
             else:
                 post = "/* empty post */\n\n"
 
             self.cprocessed = pre + self.cprocessed + post
         else:
-            print("WARNING: No template section found in %s" % (self.ppfile,), file=sys.stderr)
+            print("WARNING: No template section found in %s" % (self.ppfile,), file=self.err)
 
     def get_output(self):
         if not self._preprocessed:
-            self.apply_transformers()
-            self.apply_insert_at_exit()
+            if 'transformers' in self.pp or 'insert_at_exit' in self.pp:
+                # parse once, apply all AST changes, generate code once
+                ce = CodeEditor(self.cprocessed, self.cinputfile)
+                self.apply_transformers(ce)
+                self.apply_insert_at_exit(ce)
+                self.cprocessed = ce.output()
+            else:
+                self.apply_insert_at_exit(None)
+
             self.apply_templates()
             self._preprocessed = True
 
         return self.cprocessed
 
-    def run_cbmc(self, inputfile):
+    def get_cbmc_options(self):
         if not 'cbmc' in self.pp:
-            print("WARNING: No `cbmc' section found, using defaults", file=sys.stderr)
+            print("WARNING: No `cbmc' section found, using defaults", file=self.err)
             out = []
         else:
             translate = {'cstd': {'c99': '--c99'},
@@ -162,55 +322,278 @@ class Preprocessor(object):
                             out.append("--%s" % k)
                         out.append(str(v))
 
-        if args.json_ui:
-            out.append("--json-ui")
-
         out.append("--no-standard-checks") # CBMC 6
 
+        return out
+
+    def report_cbmc(self, success, returncode, output):
+        if success:
+            print("SUCCESS: Test passed", file=self.out)
+            if not self.options.quiet:
+                print(">>>=== CBMC Output ===<<<", file=self.out)
+                print(output.decode('utf-8'), file=self.out)
+                print(">>>=== CBMC Output End ===<<<", file=self.out)
+        else:
+            print("FAILURE: Test failed", file=self.out)
+            print("ERROR: Command failed: Return code '%s'" % (returncode,),
+                  file=self.err)
+            print("\tOutput was:\n>>>=== CBMC Output ===<<<\n%s>>>=== CBMC Output End ===<<<\n\n" % (output.decode('utf-8'),), file=self.err)
+
+        if self.options.output:
+            with open(self.options.output, "wb") as f:
+                f.write(output)
+
+        return success
+
+    def run_cbmc(self, inputfile):
+        out = self.get_cbmc_options()
+
+        if self.options.jobs > 1:
+            return self.run_cbmc_parallel(inputfile, out)
+
+        if self.options.json_ui:
+            out.append("--json-ui")
+
         cmdline = ["cbmc", inputfile] + out
-        print("INFO: Running %s" % (' '.join(cmdline)))
+        try:
+            returncode, output = self.exec_cbmc(cmdline)
+        except subprocess.TimeoutExpired as e:
+            returncode, output = self.report_timeout(e)
+
+        return self.report_cbmc(returncode == 0, returncode, output)
+
+    def report_timeout(self, e):
+        if e.timeout is None: # budget exhausted
+            msg = b"\n*** CBMC TIMED OUT ***\n"
+        else:
+            msg = b"\n*** CBMC TIMED OUT after %.1fs ***\n" % (e.timeout,)
+
+        output = (e.output or b"") + msg
+        return _sibling('runner').TIMEOUT_RETURNCODE, output
+
+    def exec_cbmc(self, cmdline, timeout = None):
+        """Run cmdline, returning its return code and output (stdout and
+           stderr). Uses the cache if available.
+
+           cmdline is run with runner.run_timeout, so it is killed along
+           with its descendants after timeout seconds, or earlier if
+           self.deadline or runner.BUDGET end first.
+
+           Raises subprocess.TimeoutExpired on a timeout."""
+
+        if self.cache:
+            x = self.cache.get(cmdline, self.out)
+            if x is not None:
+                return x
+
+        if self.deadline is not None:
+            remaining = max(0.0, self.deadline - time.monotonic())
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+                overall = True
+            else:
+                overall = False
+        else:
+            overall = timeout is None
+
+        print("INFO: Running %s" % (' '.join(cmdline)), file=self.out)
+        runner = _sibling('runner')
+        # output goes to our own file, so it is kept as raw bytes and never
+        # shortened, unlike the output runner captures
+        with tempfile.TemporaryFile() as f:
+            r = runner.run_timeout(timeout, cmdline, stdout=f, stderr=subprocess.STDOUT)
+            f.seek(0)
+            output = f.read()
+
+        if r.exception is not None:
+            raise r.exception
+
+        if r.timed_out:
+            if overall or (runner.BUDGET is not None and runner.BUDGET.expired()):
+                self.timed_out = True
+
+            raise subprocess.TimeoutExpired(cmdline, timeout, output)
+
+        if self.cache:
+            self.cache.put(cmdline, r.returncode, output)
+
+        return r.returncode, output
+
+    def get_cbmc_properties(self, inputfile, options):
+        """Return the names of the properties CBMC would check"""
+
+        cmdline = ["cbmc", inputfile] + options + ["--show-properties", "--json-ui"]
+
+        returncode, output = self.exec_cbmc(cmdline)
+        if returncode != 0:
+            return None, returncode, output
+
+        props = []
+        for x in json.loads(output):
+            if "properties" in x:
+                props.extend([pr['name'] for pr in x['properties']])
+
+        return props, returncode, output
+
+    def run_cbmc_property(self, inputfile, options, prop, timeout = None):
+        cmdline = ["cbmc", inputfile] + options + ["--property", prop, "--json-ui"]
+
+        try:
+            returncode, output = self.exec_cbmc(cmdline, timeout)
+        except subprocess.TimeoutExpired:
+            return prop, None, None
 
         try:
-            output = subprocess.check_output(cmdline, stderr=subprocess.STDOUT)
-            print("SUCCESS: Test passed")
-            if not args.quiet:
-                print(">>>=== CBMC Output ===<<<")
-                print(output.decode('utf-8'))
-                print(">>>=== CBMC Output End ===<<<")
-
-            if args.output:
-                with open(args.output, "wb") as f:
-                    f.write(output)
-
-            return True
-        except subprocess.CalledProcessError as e:
-            print("FAILURE: Test failed")
-            print("ERROR: Command failed: Return code '%s'" % (e.returncode,), 
-                  file=sys.stderr)
-            print("\tOutput was:\n>>>=== CBMC Output ===<<<\n%s>>>=== CBMC Output End ===<<<\n\n" % (e.output.decode('utf-8'),), file=sys.stderr)
-
-            if args.output:
-                with open(args.output, "wb") as f:
-                    f.write(e.output)
-            return False
+            return prop, returncode, json.loads(output)
+        except json.JSONDecodeError:
+            return prop, returncode, [{"messageType": "ERROR",
+                                       "messageText": output.decode('utf-8', errors='replace')}]
+
+    def run_cbmc_parallel(self, inputfile, options):
+        """Check each property in a separate CBMC process, options.jobs at a
+           time, and merge their JSON output into a single document
+           in the format of `cbmc --json-ui`."""
+
+        try:
+            props, rc, output = self.get_cbmc_properties(inputfile, options)
+        except subprocess.TimeoutExpired as e:
+            props = None
+            rc, output = self.report_timeout(e)
+
+        if props is None:
+            return self.report_cbmc(False, rc, output)
+
+        import concurrent.futures
+
+        print(f"INFO: Checking {len(props)} properties using {self.options.jobs} processes", file=self.out)
+
+        merged = []
+        results = []
+        returncode = 0
+        first = True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.options.jobs) as ex:
+            runs = ex.map(lambda pr: self.run_cbmc_property(inputfile, options, pr,
+                                                            self.options.property_timeout),
+                          props)
+
+            for prop, rc, j in runs:
+                if rc is None:
+                    if self.timed_out:
+                        msg = f"Checking property {prop} timed out, time limit of {self.options.timeout_s}s exceeded"
+                    else:
+                        msg = f"Checking property {prop} timed out after {self.options.property_timeout}s"
+                    print(f"WARNING: {msg}", file=self.err)
+                    merged.append({"messageType": "ERROR", "messageText": msg})
+                    results.append({"property": prop, "description": msg,
+                                    "status": "UNKNOWN"})
+                    returncode = returncode or _sibling('runner').TIMEOUT_RETURNCODE
+                    continue
+
+                if rc != 0: returncode = returncode or rc
+
+                for x in j:
+                    if "result" in x:
+                        results.extend([r for r in x['result'] if r['property'] == prop])
+                    elif "program" in x or x.get("messageType", None) == "STATUS-MESSAGE":
+                        # identical for all runs
+                        if first: merged.append(x)
+                    elif "cProverStatus" not in x:
+                        merged.append(x)
+
+                first = False
+
+        merged.append({"result": results})
+        merged.append({"cProverStatus": "success" if returncode == 0 else "failure"})
+
+        if self.options.json_ui:
+            output = json.dumps(merged, indent=2)
+        else:
+            output = "\n".join(_sibling('cbmc_trace').CBMCTrace(merged).json_to_text())
+
+        return self.report_cbmc(returncode == 0, returncode, output.encode('utf-8'))
 
     def check(self, preserve_output = False):
+        if self.options.timeout_s is not None:
+            self.deadline = time.monotonic() + self.options.timeout_s
+
         h, tmpfile = tempfile.mkstemp(".c")
         os.close(h)
 
-        print("INFO: Storing output in `%s`" % (tmpfile,))
+        print("INFO: Storing output in `%s`" % (tmpfile,), file=self.out)
 
         with open(tmpfile, "w") as f:
             f.write(self.get_output())
 
-        x = self.run_cbmc(tmpfile,)
-        if not preserve_output:
-            print("INFO: Removing `%s`" % (tmpfile,))
-            os.unlink(tmpfile)
+        try:
+            x = self.run_cbmc(tmpfile,)
+        finally:
+            if not preserve_output:
+                print("INFO: Removing `%s`" % (tmpfile,), file=self.out)
+                os.unlink(tmpfile)
 
         return x
 
+def check_cbmc(cfile, preprocessoryaml, **options):
+    """Run check_cbmc in this process instead of as a separate command.
+
+       options are the fields of Options, corresponding to the command
+       line arguments. cache defaults to $CBMC_CACHE_DIR. timeout_s
+       limits the total time of all CBMC runs, which are also killed
+       when runner.BUDGET runs out; the result then has timed_out set.
+
+       Returns a runner.RunResult containing what the command would have
+       printed, so it can be used with runtests.CBMCRunTest."""
+
+    import io
+    import time
+    import traceback
+    from . import runner
+
+    options.setdefault('cache', os.environ.get("CBMC_CACHE_DIR", None))
+    options = Options(**options)
+
+    out = io.StringIO()
+    err = io.StringIO()
+    exception = None
+    start = time.monotonic()
+    x = None
+
+    try:
+        x = Preprocessor(preprocessoryaml, options, out, err)
+        if options.cache:
+            x.cache = CBMCCache(options.cache, options.cache_size*1024*1024)
+
+        x.set_input(cfile)
+        ok = x.check(options.keep)
+    except CPPError as e:
+        print("ERROR: preprocessor failed.\n", file=err)
+        print(e, file=err)
+        ok = False
+    except Exception as e:
+        traceback.print_exc(file=err)
+        exception = e
+        ok = False
+
+    timed_out = x is not None and x.timed_out
+    if timed_out:
+        returncode = runner.TIMEOUT_RETURNCODE
+    else:
+        returncode = 0 if ok else 1
+
+    return runner.RunResult(success = ok,
+                            returncode = returncode,
+                            output = out.getvalue(),
+                            errors = err.getvalue(),
+                            exception = exception,
+                            processobj = None,
+                            outfile = None,
+                            errfile = None,
+                            timed_out = timed_out,
+                            wall_time = time.monotonic() - start)
+
 if __name__ == "__main__":
+    import argparse
+
     p = argparse.ArgumentParser(description="Preprocess a file and run it through cbmc")
 
     p.add_argument("cfile", help="File to check")
@@ -219,13 +602,29 @@ if __name__ == "__main__":
     p.add_argument("--json-ui", action="store_true", help="Use JSON UI")
     p.add_argument("-o", dest="output", help="Output file for cbmc output")
     p.add_argument("-q", dest="quiet", action="store_true", help="Don't show cbmc output")
+    p.add_argument("-j", dest="jobs", type=int, default=1, help="Check properties in parallel using this many cbmc processes")
+    p.add_argument("--property-timeout", type=int, help="Timeout in seconds for each property when checking in parallel")
+    p.add_argument("--timeout", dest="timeout_s", type=float, help="Timeout in seconds for all cbmc runs")
+    p.add_argument("--cache", dest="cache", default=os.environ.get("CBMC_CACHE_DIR", None),
+                   help="Directory to cache CBMC output in (default: $CBMC_CACHE_DIR, if set)")
+    p.add_argument("--cache-size", dest="cache_size", type=int, default=512, help="Maximum size of the cache in MB")
 
     args = p.parse_args()
 
-    x = Preprocessor(args.preprocessoryaml)
+    x = Preprocessor(args.preprocessoryaml, args)
+    if args.cache:
+        x.cache = CBMCCache(args.cache, args.cache_size*1024*1024)
+
     x.set_input(args.cfile)
 
-    if x.check(args.keep,):
+    try:
+        ok = x.check(args.keep,)
+    except CPPError as e:
+        print("ERROR: preprocessor failed.\n", file=sys.stderr)
+        print(e, file=sys.stderr)
+        ok = False
+
+    if ok:
         sys.exit(0)
     else:
         sys.exit(1)
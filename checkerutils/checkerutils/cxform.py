@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
 import sys
+import re
+import copy
 import pycparser
 from pycparser import c_generator, c_ast, parse_file
 
 class Transformer(object):
+    # used by ASTTransformer to only consult transformers that could
+    # match: node_types is a tuple of c_ast classes (None for any),
+    # function is the name of the function (None for anywhere)
+    node_types = None
+    function = None
+
     def matches(self, node, context = None):
         return False
 
@@ -13,6 +21,7 @@ class Transformer(object):
 
 class PrintfTransformer(Transformer):
     xform_name = 'printfX'
+    node_types = (c_ast.FuncCall,)
 
     def matches(self, node, context = None):
         if isinstance(node, c_ast.FuncCall) and isinstance(node.name, c_ast.ID):
@@ -23,6 +32,8 @@ class PrintfTransformer(Transformer):
         return node
 
 class PostconditionTransformer(Transformer):
+    node_types = (c_ast.Return,)
+
     def __init__(self, args):
         ct = args.get('condition_text', args["condition"])
         condition = f"__CPROVER_assert({args['condition']}, \"{ct}\");"
@@ -37,10 +48,12 @@ class PostconditionTransformer(Transformer):
         return context['function'] == self.function and isinstance(node, c_ast.Return)
 
     def transform(self, node):
-        y = c_ast.Compound([x for x in self.code_ast] + [node])
+        y = c_ast.Compound(copy.deepcopy(self.code_ast) + [node])
         return y
 
 class PreconditionTransformer(Transformer):
+    node_types = (c_ast.FuncDef,)
+
     def __init__(self, args):
         self.function = args['function']
 
@@ -64,63 +77,137 @@ class PreconditionTransformer(Transformer):
         return self.function == context['function'] and isinstance(node, c_ast.FuncDef)
 
     def transform(self, node):
-        for c in reversed(self.code_ast):
+        if node.body.block_items is None:
+            node.body.block_items = []
+
+        for c in reversed(copy.deepcopy(self.code_ast)):
             node.body.block_items.insert(0, c)
         return node
 
-# rather stupid way ...
+CHILD_RE = re.compile(r'^(\w+)\[(\d+)\]$')
+
 class ASTTransformer(c_generator.CGenerator):
+    """Applies transformers to an AST. For each node, the first
+       transformer that matches it transforms it.
+
+       Transformers are indexed by the node types and function they
+       apply to, so only candidates are asked if they match."""
+
     def __init__(self, transformers):
         self.xformers = transformers
-        self.seen = set()
-        super(ASTTransformer).__init__()
+        super(ASTTransformer, self).__init__()
         self.indent_level = 0
         self.function = None
 
-    def visit(self, node):
-        if node in self.seen:
-            return super(ASTTransformer, self).visit(node)
+        # (node type, function) -> [(order, transformer)], None is wildcard
+        self._index = {}
+        for i, xf in enumerate(self.xformers):
+            for nt in (xf.node_types or (None,)):
+                self._index.setdefault((nt, xf.function), []).append((i, xf))
 
-        self.seen.add(node)
+        self._candidates = {}
+
+    def candidates(self, node_type, function):
+        k = (node_type, function)
+        if k not in self._candidates:
+            c = []
+            for nt in {node_type, None}:
+                for fn in {function, None}:
+                    c.extend(self._index.get((nt, fn), []))
+
+            self._candidates[k] = [xf for _, xf in sorted(c, key=lambda x: x[0])]
+
+        return self._candidates[k]
+
+    def _apply(self, node):
+        xfs = self.candidates(type(node), self.function)
+        if xfs:
+            context = {'function': self.function}
+            for xf in xfs:
+                if xf.matches(node, context):
+                    return xf.transform(node)
+
+        return node
 
+    def _transform_children(self, node, done = None):
+        """Transform the children of node. done is a node that has
+           already been transformed, whose children are transformed
+           if it is encountered."""
+
+        replace = {}
+        for name, child in node.children():
+            if child is done:
+                self._transform_children(child)
+                continue
+
+            nc = self._transform_ast(child)
+            if nc is not child:
+                replace[name] = nc
+
+        if not replace:
+            return
+
+        lists = {}
+        for name, nc in replace.items():
+            m = CHILD_RE.match(name)
+            if m:
+                lists.setdefault(m.group(1), {})[int(m.group(2))] = nc
+            else:
+                # TODO: lists returned for a single child
+                setattr(node, name, nc)
+
+        for attr, idx in lists.items():
+            out = []
+            for i, c in enumerate(getattr(node, attr)):
+                if i in idx:
+                    c = idx[i]
+                    if c is None: # node got deleted
+                        continue
+                    elif isinstance(c, list):
+                        out.extend(c)
+                        continue
+
+                out.append(c)
+
+            setattr(node, attr, out)
+
+    def _transform_ast(self, node):
         func_set = False
         if isinstance(node, c_ast.FuncDef):
             self.function = node.decl.name
             func_set = True
 
-        context = {'function': self.function}
-        nn = node
-        for xf in self.xformers:
-            if xf.matches(node, context):
-                nn = xf.transform(node)
-                break
-
-        if nn is not None: # node got deleted
-            if not isinstance(nn, list):
-                t =super(ASTTransformer, self).visit(nn)
-                if func_set: self.function = None
-                return t
-            else:
-                # TODO
-                pass
-        else:
-            if func_set: self.function = None
-            return ''
+        nn = self._apply(node)
 
+        if nn is node:
+            self._transform_children(node)
+        elif nn is not None:
+            for n in (nn if isinstance(nn, list) else [nn]):
+                if n is node:
+                    # already transformed, but its children are not
+                    self._transform_children(node)
+                else:
+                    self._transform_children(n, done = node)
+
+        if func_set: self.function = None
+        return nn
+
+    def transform_ast(self, ast):
+        """Apply the transformers to ast in place, without generating
+           and reparsing C code, and return the transformed AST."""
+
+        self.function = None
+        return self._transform_ast(ast)
 
     def transform_string(self, c_code):
         p = pycparser.c_parser.CParser()
         ast = p.parse(c_code)
 
-        newcode = self.visit(ast)
+        newcode = self.visit(self.transform_ast(ast))
         return newcode
 
     def transform(self, node):
-        newcode = self.visit(node)
-        p = pycparser.c_parser.CParser()
-        newast = p.parse(newcode)
-
-        return newast
+        return self.transform_ast(node)
 
 if __name__ == "__main__":
     import argparse
@@ -12,6 +12,8 @@ import json
 import os
 from pathlib import Path
 import logging
+import tempfile
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +26,14 @@ VIS_DEFAULT = VIS_VISIBLE
 
 VIS_VALID = {VIS_HIDDEN, VIS_AFTER_DUE_DATE, VIS_AFTER_PUBLISHED, VIS_VISIBLE}
 
+# shown after the names of tests that are not visible
+VIS_NAMES = {VIS_AFTER_DUE_DATE: "After Due Date",
+             VIS_AFTER_PUBLISHED: "After Published",
+             VIS_HIDDEN: "Hidden"}
+
+# minimum seconds between writes by GSResults.checkpoint
+CHECKPOINT_INTERVAL = 1.0
+
 # internal
 STATUS_SUCCESS = 0
 STATUS_FAIL = 1
@@ -47,20 +57,55 @@ class GSEnv(object):
 class GSTest(object):
     """A test in the results.json file.
 
+       Uses __slots__, and creates the output, tags and extra_data
+       containers only when they are first used, since assignments may
+       have thousands of tests.
+
        TODO: Make this a generic test."""
+
+    __slots__ = ('name', 'score', 'max_score', 'number', 'visibility',
+                 'passed', '_status', '_output', '_tags', '_extra_data')
+
     def __init__(self, name, score = None, max_score = None, number = None, output = ""):
         self.name = name
         self.score = score
         self.max_score = max_score
         self.number = number
-        self.output = []
-        self.tags = []
         self.visibility = None
-        self.extra_data = dict()
         self.passed = None
         self._status = None
+        self._output = None
+        self._tags = None
+        self._extra_data = None
         if output != "": self.add_output(output)
 
+    @property
+    def output(self):
+        if self._output is None: self._output = []
+        return self._output
+
+    @output.setter
+    def output(self, v):
+        self._output = v
+
+    @property
+    def tags(self):
+        if self._tags is None: self._tags = []
+        return self._tags
+
+    @tags.setter
+    def tags(self, v):
+        self._tags = v
+
+    @property
+    def extra_data(self):
+        if self._extra_data is None: self._extra_data = dict()
+        return self._extra_data
+
+    @extra_data.setter
+    def extra_data(self, v):
+        self._extra_data = v
+
     def success(self):
         return self._status == STATUS_SUCCESS
 
@@ -79,28 +124,86 @@ class GSTest(object):
     def add_extra_data(self, key, value):
         self.extra_data[key] = value
 
-    def to_dict(self):
+    @classmethod
+    def from_dict(cls, d):
+        """Create a test from its entry in a results.json file"""
+
+        name = d.get('name')
+        v = d.get('visibility')
+        if name is not None and v in VIS_NAMES:
+            name = name.removesuffix(f" (Visibility: {VIS_NAMES[v]})")
+
+        t = cls(name, d.get('score'), d.get('max_score'), d.get('number'),
+                d.get('output', ""))
+        if d.get('tags'): t.tags = list(d['tags'])
+        t.visibility = v
+        if d.get('extra_data'): t.extra_data = dict(d['extra_data'])
+        if 'status' in d: t.passed = d['status'] == 'passed'
+        return t
+
+    def to_dict(self, stream = False, decorate = False):
+        """If stream is True, output is returned as OutputLines instead
+           of a single string. If decorate is True, the visibility is
+           added to the name, as in results.json."""
+
         out = {}
 
-        for a in ['name', 'score', 'max_score', 'number', 'output',
-                  'tags', 'visibility', 'extra_data', 'passed']:
-            v = getattr(self, a)
-            if v is not None:
-                if a == 'output':
-                    if len(v): out['output'] = "\n".join(v)
-                elif a in ('tags', 'extra_data'):
-                    if len(v): out[a] = v
-                elif a == 'passed':
-                    out['status'] = 'passed' if v else 'failed'
-                else:
-                    out[a] = v
+        if self.name is not None:
+            out['name'] = self.name
+            if decorate and self.visibility is not None and self.visibility != VIS_VISIBLE:
+                v = VIS_NAMES.get(self.visibility, self.visibility)
+                out['name'] = self.name + f" (Visibility: {v})"
+
+        if self.score is not None: out['score'] = self.score
+        if self.max_score is not None: out['max_score'] = self.max_score
+        if self.number is not None: out['number'] = self.number
+        if self._output: out['output'] = OutputLines(self._output) if stream else "\n".join(self._output)
+        if self._tags: out['tags'] = self._tags
+        if self.visibility is not None: out['visibility'] = self.visibility
+        if self._extra_data: out['extra_data'] = self._extra_data
+        if self.passed is not None: out['status'] = 'passed' if self.passed else 'failed'
 
         return out
 
+class OutputLines(list):
+    """Lines of output, written by write_json as a single string joined by
+       newlines without building that string in memory."""
+    pass
+
+def write_json(f, v, indent = 0):
+    """Write v as JSON to the file f, like json.dump(v, f, indent=4), but
+       writing OutputLines piecewise."""
+
+    if isinstance(v, OutputLines):
+        f.write('"')
+        for i, l in enumerate(v):
+            if i > 0: f.write('\\n')
+            f.write(json.dumps(l)[1:-1])
+        f.write('"')
+    elif isinstance(v, dict) and len(v):
+        pfx = "\n" + " " * (indent + 4)
+        f.write("{")
+        for i, (k, x) in enumerate(v.items()):
+            f.write(("," if i > 0 else "") + pfx + json.dumps(k) + ": ")
+            write_json(f, x, indent + 4)
+        f.write("\n" + " " * indent + "}")
+    elif isinstance(v, list) and len(v):
+        pfx = "\n" + " " * (indent + 4)
+        f.write("[")
+        for i, x in enumerate(v):
+            f.write(("," if i > 0 else "") + pfx)
+            write_json(f, x, indent + 4)
+        f.write("\n" + " " * indent + "]")
+    else:
+        f.write(json.dumps(v))
+
 class GSResults(object):
     """Represents a results.json file
 
-       TODO: Read a results.json file, so this can be incrementally modified."""
+       read() loads an existing results.json file, so it can be
+       incrementally modified. write() replaces the file atomically, and
+       checkpoint() can be called periodically so that partial results
+       survive the autograder being killed."""
 
     execution_time = None # seconds
     score = None
@@ -113,6 +216,21 @@ class GSResults(object):
         self.output = []
         self.extra_data = dict()
         self.tests = []
+        self._last_write = None
+
+    def read(self):
+        """Load the existing results file"""
+
+        with open(self.jf, "r") as f:
+            d = json.load(f)
+
+        for a in ['execution_time', 'score', 'visibility', 'stdout_visibility']:
+            if a in d: setattr(self, a, d[a])
+
+        if 'output' in d: self.output = [d['output']]
+        self.extra_data = dict(d.get('extra_data', {}))
+        self.tests = [GSTest.from_dict(t) for t in d.get('tests', [])]
+        return self
 
     def add_output(self, t):
         """This is output at top of file"""
@@ -124,6 +242,15 @@ class GSResults(object):
     def add_test(self, t):
         self.tests.append(t)
 
+    def mark_skipped(self, message = "*** SKIPPED: the autograder ran out of time"):
+        """Add message to every test that has no output or status yet,
+           i.e., that was never run."""
+
+        for t in self.tests:
+            if not t._output and t.passed is None:
+                t.add_output(message)
+                t.add_tag('skipped')
+
     @property
     def last_test(self):
         return self.tests[-1]
@@ -132,58 +259,84 @@ class GSResults(object):
         raise NotImplementedError
 
     def get_results_json(self):
-        d = self.to_dict()
+        return json.dumps(self._results_dict(), indent=4)
 
-        #TODO: check for errors in results.json file
-        if 'score' not in d and 'tests' in d:
-            for t in d['tests']:
-                if 'score' not in t and 'status' not in t:
-                    raise ValueError(f'results.json does not contain scores or status for {t["name"]}')
+    def _results_dict(self, stream = False):
+        #TODO: check for more errors in results.json file
+        return self.to_dict(stream, decorate = True)
 
-        # improve UI
-        if 'tests' in d:
-            for t in d['tests']:
-                if 'visibility' in t and t['visibility'] != VIS_VISIBLE:
-                    v = t['visibility']
+    def to_dict(self, stream = False, decorate = False):
+        """Returns the contents of results.json as a dict. If decorate is
+           True, tests are also checked for scores and their names
+           decorated (see GSTest.to_dict), as in results.json."""
 
-                    if v == VIS_AFTER_DUE_DATE:
-                        v = "After Due Date"
-                    elif v == VIS_AFTER_PUBLISHED:
-                        v = "After Published"
-                    elif v == VIS_HIDDEN:
-                        v = "Hidden"
+        out = {}
 
-                    t['name'] = t['name'] + f" (Visibility: {v})"
+        for a in ['execution_time', 'score', 'visibility', 'stdout_visibility']:
+            v = getattr(self, a)
+            if v is not None: out[a] = v
 
-        return json.dumps(d, indent=4)
+        if self.extra_data: out['extra_data'] = self.extra_data
 
-    def to_dict(self):
-        out = {}
+        if self.tests:
+            check_score = decorate and self.score is None
+            tests = []
+            for x in self.tests:
+                t = x.to_dict(stream, decorate)
+                if not t:
+                    # this is valid since all fields in test are
+                    # optional, but almost certainly not what you
+                    # want
+                    raise ValueError("Some tests are empty")
 
-        for a in ['execution_time', 'score', 'visibility', 'stdout_visibility',
-                  'extra_data', 'tests', 'output']:
-            v = getattr(self, a)
-            if v is not None:
-                if a == 'output':
-                     if len(v) > 0: out['output'] = "\n".join(v)
-                elif a == 'extra_data':
-                    if len(v) > 0: out[a] = v
-                elif a == 'tests':
-                    if len(v) > 0:
-                        out[a] = [x.to_dict() for x in v]
-                        if any([len(x) == 0 for x in out[a]]):
-                            # this is valid since all fields in test are
-                            # optional, but almost certainly not what you
-                            # want
-                            raise ValueError("Some tests are empty")
-                else:
-                    out[a] = v
+                if check_score and 'score' not in t and 'status' not in t:
+                    raise ValueError(f'results.json does not contain scores or status for {x.name}')
+
+                tests.append(t)
+
+            out['tests'] = tests
+
+        if self.output:
+            out['output'] = OutputLines(self.output) if stream else "\n".join(self.output)
 
         return out
 
     def write(self):
-        with open(self.jf, "w") as f:
-            f.write(self.get_results_json())
+        d = self._results_dict(stream = True)
+
+        # write to a temporary file and rename it, so that readers (and
+        # a later run) never see a partially written file
+        h, tmp = tempfile.mkstemp(dir=os.path.dirname(self.jf) or '.', prefix='.results-')
+        try:
+            with os.fdopen(h, "w") as f:
+                write_json(f, d)
+
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.jf)
+        except BaseException: # including BudgetExpired
+            os.unlink(tmp)
+            raise
+
+        self._last_write = time.monotonic()
+
+    def checkpoint(self, force = False):
+        """Write the results if at least CHECKPOINT_INTERVAL seconds have
+           passed since they were last written, or if force is True.
+
+           Returns True if the results were written. Results that are not
+           yet valid are not written."""
+
+        if not force and self._last_write is not None:
+            if time.monotonic() - self._last_write < CHECKPOINT_INTERVAL:
+                return False
+
+        try:
+            self.write()
+        except ValueError as e:
+            logger.debug(f'Not checkpointing results: {e}')
+            return False
+
+        return True
 
 class PropDict(object):
     def from_dict(self, d):
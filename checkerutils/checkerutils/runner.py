@@ -13,31 +13,446 @@ import logging
 from collections import namedtuple
 import tempfile
 import os
+import selectors
+import signal
+import time
+import resource
 
 MAX_OUTPUT = 0
+
+# which part of the output is kept when it is longer than the limit
+POLICY_HEAD = 'head' # the beginning
+POLICY_TAIL = 'tail' # the end
+POLICY_HEAD_TAIL = 'head+tail' # half of each, with a marker in between
+OUTPUT_POLICY = POLICY_HEAD_TAIL
+
+# how output is captured when stdout/stderr are not provided
+CAPTURE_FILE = 'file' # write to temporary files, read them back
+CAPTURE_PIPE = 'pipe' # read pipes concurrently into memory
+CAPTURE = CAPTURE_FILE
+
+# in CAPTURE_PIPE mode, output larger than this is spilled to a temporary file
+SPILL_SIZE = 16*1024*1024
+
+# resource limits applied by run_timeout, keys are those of RLIMITS
+DEFAULT_LIMITS = {}
+
+# if set to a list, run() appends a dict with the timing of each command
+# it runs (see record_timing)
+TIMINGS = None
+
+# if set to a dict, run() adds the timing of each command it runs to
+# totals over all commands (see record_timing)
+TIMING_TOTALS = None
+
+# if set to a TimeBudget, run_timeout fits all timeouts into it
+BUDGET = None
+
+RLIMITS = {'cpu': resource.RLIMIT_CPU,     # seconds of CPU time
+           'as': resource.RLIMIT_AS,       # bytes of address space
+           'nproc': resource.RLIMIT_NPROC, # processes, counted per user
+           'fsize': resource.RLIMIT_FSIZE, # bytes written to any one file
+           }
+
+# return code reported for commands that timed out, as timeout(1) does
+TIMEOUT_RETURNCODE = 124
+
 logger = logging.getLogger(__name__)
 
-RunResult = namedtuple('RUN_RESULT', 'success returncode output errors exception processobj outfile errfile')
+# timed_out: killed after exceeding the wall-clock timeout
+# cpu_time: user + system time in seconds, max_rss: in kilobytes, wall_time: in seconds
+RunResult = namedtuple('RUN_RESULT', 'success returncode output errors exception processobj outfile errfile timed_out cpu_time max_rss wall_time',
+                       defaults = (False, None, None, None))
+
+# a command for run_many, with its own arguments to run/run_timeout
+Command = namedtuple('COMMAND', 'cmd kwargs timeout_s', defaults = (None, None))
+
+def _elide(head, tail, omitted, policy):
+    """Join the kept parts of an output, marking where omitted characters
+       (or bytes) were dropped."""
+
+    marker = f"*** PARTIAL OUTPUT: {omitted} omitted ***"
+    if isinstance(head, bytes):
+        marker = marker.encode('utf-8')
+        nl = b"\n"
+    else:
+        nl = "\n"
+
+    if policy == POLICY_HEAD:
+        return head + nl + marker + nl
+    elif policy == POLICY_TAIL:
+        return marker + nl + tail
+    else:
+        return head + nl + marker + nl + tail
+
+def _split_limit(limit, policy):
+    """Return how much of the head and the tail to keep"""
 
-def shorten(output, max_len = MAX_OUTPUT):
+    if policy == POLICY_HEAD:
+        return limit, 0
+    elif policy == POLICY_TAIL:
+        return 0, limit
+    else:
+        assert policy == POLICY_HEAD_TAIL, f"Unknown output policy {policy}"
+        return limit // 2, limit - limit // 2
+
+def shorten(output, max_len = MAX_OUTPUT, policy = None):
     if max_len == 0:
         return output
 
     if len(output) > max_len:
-        return "*** PARTIAL OUTPUT ***\n" + output[-max_len:]
+        hl, tl = _split_limit(max_len, policy or OUTPUT_POLICY)
+        return _elide(output[:hl], output[len(output)-tl:], len(output) - max_len,
+                      policy or OUTPUT_POLICY)
 
     return output
 
-def safe_read(f):
+def safe_read(f, limit = None, policy = None):
+    """Read file f, keeping at most limit (default MAX_OUTPUT) bytes
+       according to policy (default OUTPUT_POLICY)."""
+
+    if limit is None: limit = MAX_OUTPUT
+    if policy is None: policy = OUTPUT_POLICY
+
     with open(f, "rb") as h:
-        if MAX_OUTPUT == 0:
+        size = os.fstat(h.fileno()).st_size
+        if limit == 0 or size <= limit:
             return h.read()
+
+        hl, tl = _split_limit(limit, policy)
+        head = h.read(hl)
+        h.seek(size - tl)
+        tail = h.read(tl)
+        return _elide(head, tail, size - limit, policy)
+
+class OutputBuffer(object):
+    """Accumulates output read from a pipe.
+
+       Like safe_read, keeps at most limit (default MAX_OUTPUT) bytes
+       according to policy, discarding the rest as it arrives. Once
+       more than limit bytes have been written, exceeded is set, and
+       if kill_on_limit is set, the command should be killed.
+
+       When there is no limit, output beyond spill_size bytes is moved
+       to a temporary file instead of being held in memory."""
+
+    def __init__(self, spill_size = None, limit = None, policy = None, kill_on_limit = False):
+        self.limit = MAX_OUTPUT if limit is None else limit
+        self.policy = policy or OUTPUT_POLICY
+        self.kill_on_limit = kill_on_limit
+        self.exceeded = False
+        self.killed = False
+
+        self.spill_size = SPILL_SIZE if spill_size is None else spill_size
+        self.chunks = []
+        self.size = 0
+        self.spillfile = None
+        self._spill = None
+
+        self._hl, self._tl = _split_limit(self.limit, self.policy)
+        self.head = bytearray()
+        self.tail = bytearray()
+
+    def write(self, data):
+        self.size += len(data)
+
+        if self.limit:
+            if len(self.head) < self._hl:
+                n = self._hl - len(self.head)
+                self.head += data[:n]
+                data = data[n:]
+
+            if self._tl and data:
+                self.tail += data
+                if len(self.tail) > self._tl:
+                    del self.tail[:len(self.tail) - self._tl]
+
+            if self.size > self.limit:
+                self.exceeded = True
+        elif self._spill is not None:
+            self._spill.write(data)
         else:
-            return h.read(MAX_OUTPUT)
+            self.chunks.append(data)
+            if self.spill_size and self.size > self.spill_size:
+                h, self.spillfile = tempfile.mkstemp()
+                logger.info(f'Spilling output to {self.spillfile}')
+                self._spill = os.fdopen(h, "wb")
+                self._spill.write(b"".join(self.chunks))
+                self.chunks = []
+
+    def getvalue(self):
+        if self.limit:
+            if self.exceeded:
+                out = _elide(bytes(self.head), bytes(self.tail),
+                             self.size - len(self.head) - len(self.tail), self.policy)
+            else:
+                out = bytes(self.head + self.tail)
+
+            if self.killed:
+                out += b"\n*** OUTPUT LIMIT EXCEEDED, COMMAND KILLED ***\n"
+
+            return out
+
+        if self._spill is not None:
+            self._spill.flush()
+            return safe_read(self.spillfile, 0)
+
+        return b"".join(self.chunks)
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            os.unlink(self.spillfile)
+            self._spill = None
+
+class BudgetExpired(BaseException):
+    """Raised (by a SIGALRM handler, see TimeBudget.arm) when the time
+       budget runs out. Like KeyboardInterrupt, it is not an Exception,
+       so that checkers do not catch it by accident."""
+    pass
+
+class TimeBudget(object):
+    """Tracks the time left before a deadline, such as the autograder
+       timeout.
+
+       The budget ends reserve seconds before the deadline, to leave
+       time for writing results."""
+
+    def __init__(self, seconds, reserve = 0):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds - reserve
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def timeout(self, timeout_s):
+        """Return timeout_s, reduced so that it ends within the budget"""
+
+        r = self.remaining()
+        if timeout_s is None or timeout_s > r:
+            if timeout_s is not None:
+                logger.warning(f'Reducing timeout from {timeout_s}s to {r:.1f}s, the remaining time budget')
+            return r
+
+        return timeout_s
+
+    def arm(self):
+        """Raise BudgetExpired in the main thread when the budget ends"""
+
+        def expired(signum, frame):
+            raise BudgetExpired(f'Time budget of {self.seconds:.1f}s expired')
+
+        signal.signal(signal.SIGALRM, expired)
+        signal.setitimer(signal.ITIMER_REAL, max(self.remaining(), 0.001))
+
+    def disarm(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+def _set_limits(limits, preexec_fn = None):
+    """Return a preexec_fn that applies limits in the child"""
+
+    def f():
+        for k, v in limits.items():
+            resource.setrlimit(RLIMITS[k], (v, v))
+
+        if preexec_fn is not None:
+            preexec_fn()
+
+    return f
+
+def _wait4(process, deadline):
+    """Wait for process until deadline, returning its resource usage, or
+       None if the deadline passed."""
+
+    delay = 0.0005
+    while True:
+        pid, status, ru = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+        if pid != 0:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return ru
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+def _kill(process, group):
+    if group:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        process.kill()
+
+def _run_process(cmd, outbuf, errbuf, *args, timeout = None, wall_timeout = None,
+                 limits = None, **kwargs):
+    """Run cmd, reading stdout/stderr pipes concurrently into outbuf
+       and errbuf (if they are not None).
+
+       Mimics subprocess.run, including the input, timeout and check
+       arguments. If wall_timeout is given, the command's process group
+       is killed after that many seconds instead of raising
+       TimeoutExpired. The process group is also killed when a buffer
+       with kill_on_limit exceeds its limit, after which the pipes are
+       closed without reading them to the end.
+
+       Returns the process object, whether it timed out, its resource
+       usage and its wall time."""
+
+    check = kwargs.pop('check', False)
+    stdin_data = kwargs.pop('input', None)
+
+    if outbuf is not None: kwargs['stdout'] = subprocess.PIPE
+    if errbuf is not None: kwargs['stderr'] = subprocess.PIPE
+    if stdin_data is not None: kwargs['stdin'] = subprocess.PIPE
+
+    if wall_timeout is not None:
+        timeout = wall_timeout
+        kwargs.setdefault('start_new_session', True)
+
+    # so that descendants holding the pipes open are killed too
+    if any(b is not None and b.kill_on_limit for b in (outbuf, errbuf)):
+        kwargs.setdefault('start_new_session', True)
+
+    if limits:
+        kwargs['preexec_fn'] = _set_limits(limits, kwargs.get('preexec_fn', None))
+
+    start = time.monotonic()
+    deadline = start + timeout if timeout is not None else None
+    timed_out = False
+
+    process = subprocess.Popen(cmd, *args, **kwargs)
+    killed = False
+    try:
+        with selectors.DefaultSelector() as sel:
+            if outbuf is not None: sel.register(process.stdout, selectors.EVENT_READ, outbuf)
+            if errbuf is not None: sel.register(process.stderr, selectors.EVENT_READ, errbuf)
+            if stdin_data is not None:
+                stdin_data = memoryview(stdin_data)
+                sel.register(process.stdin, selectors.EVENT_WRITE)
+
+            while sel.get_map() and not killed:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        timed_out = True
+                        break
+
+                for key, _ in sel.select(remaining):
+                    if key.fileobj is process.stdin:
+                        try:
+                            n = os.write(key.fd, stdin_data[:65536])
+                        except BrokenPipeError:
+                            n = len(stdin_data)
+
+                        stdin_data = stdin_data[n:]
+                        if not len(stdin_data):
+                            sel.unregister(key.fileobj)
+                            key.fileobj.close()
+                        continue
+
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        buf = key.data
+                        buf.write(data)
+                        if buf.exceeded and buf.kill_on_limit and not buf.killed:
+                            logger.error(f'Output limit of {buf.limit} bytes exceeded, killing {cmd}')
+                            _kill(process, kwargs.get('start_new_session', False))
+                            buf.killed = killed = True
+                            break
+                    else:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+
+            # don't read to EOF, which any surviving descendant could delay forever
+            if killed:
+                for key in list(sel.get_map().values()):
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+
+        ru = None
+        if not timed_out:
+            ru = _wait4(process, deadline)
+            timed_out = ru is None
+
+        if timed_out:
+            _kill(process, kwargs.get('start_new_session', False))
+            ru = _wait4(process, None)
+    finally:
+        for f in (process.stdin, process.stdout, process.stderr):
+            if f is not None: f.close()
+
+        if process.returncode is None:
+            # exception while running, don't leave it behind
+            _kill(process, kwargs.get('start_new_session', False))
+            process.wait()
+
+    wall = time.monotonic() - start
+
+    if timed_out:
+        if wall_timeout is None:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+
+        process.returncode = TIMEOUT_RETURNCODE
+
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    return process, timed_out, ru, wall
+
+def record_timing(command, start, wall, ru, returncode):
+    """Append the timing of a command to TIMINGS, and add it to
+       TIMING_TOTALS, if they are set.
+
+       start is the time.time() at which command started, wall its
+       elapsed time and ru its resource usage (from os.wait4)."""
+
+    cpu = ru.ru_utime + ru.ru_stime
+
+    if TIMINGS is not None:
+        TIMINGS.append({'command': command,
+                        'start': start,
+                        'wall_time': round(wall, 6),
+                        'cpu_time': cpu,
+                        'max_rss': ru.ru_maxrss,
+                        'returncode': returncode})
+
+    if TIMING_TOTALS is not None:
+        t = TIMING_TOTALS
+        t['commands'] = t.get('commands', 0) + 1
+        t['wall_time'] = round(t.get('wall_time', 0) + wall, 6)
+        t['cpu_time'] = round(t.get('cpu_time', 0) + cpu, 6)
+        t['max_rss'] = max(t.get('max_rss', 0), ru.ru_maxrss)
+
+def run(cmd, *args, capture = None, spill_size = None, output_limit = None,
+        output_policy = None, kill_on_output_limit = False, **kwargs):
+    """Run cmd, capturing its stdout and stderr unless they are provided.
+
+       capture is CAPTURE_FILE or CAPTURE_PIPE (default CAPTURE).
+       spill_size overrides SPILL_SIZE for CAPTURE_PIPE.
+
+       output_limit and output_policy override MAX_OUTPUT and
+       OUTPUT_POLICY for each of stdout and stderr. Limits are enforced
+       while the command runs, so output is always captured through
+       pipes when output_limit is given or MAX_OUTPUT is non-zero. If
+       kill_on_output_limit is set, the command is killed once it
+       exceeds the limit.
+
+       See _run_process for wall_timeout and limits."""
 
-def run(cmd, *args, **kwargs):
     assert type(cmd) is not str
 
+    if capture is None: capture = CAPTURE
+    if output_limit is not None or kill_on_output_limit or MAX_OUTPUT:
+        capture = CAPTURE_PIPE
+
     cmd = [str(s) for s in cmd]
 
     command = " ".join(cmd)
@@ -48,19 +463,27 @@ def run(cmd, *args, **kwargs):
     output = None
     errors = None
 
+    outbuf = None
+    errbuf = None
+
     try:
-        if 'stdin' not in kwargs:
+        if 'stdin' not in kwargs and 'input' not in kwargs:
             kwargs['stdin'] = subprocess.DEVNULL
 
         outfile = None
         errfile = None
 
-        if 'stdout' not in kwargs:
+        if capture == CAPTURE_PIPE:
+            if 'stdout' not in kwargs:
+                outbuf = OutputBuffer(spill_size, output_limit, output_policy, kill_on_output_limit)
+            if 'stderr' not in kwargs:
+                errbuf = OutputBuffer(spill_size, output_limit, output_policy, kill_on_output_limit)
+        elif 'stdout' not in kwargs:
             hout, outfile = tempfile.mkstemp()
             logger.info(f'Logging output to {outfile}')
             kwargs['stdout'] = hout
 
-        if 'stderr' not in kwargs:
+        if capture != CAPTURE_PIPE and 'stderr' not in kwargs:
             herr, errfile = tempfile.mkstemp()
             logger.info(f'Logging errors to {errfile}')
             kwargs['stderr'] = herr
@@ -70,14 +493,29 @@ def run(cmd, *args, **kwargs):
         else:
             logging.info(f'Running {command}')
 
-        process = subprocess.run(cmd, *args, **kwargs)
+        start = time.time()
+        process, timed_out, ru, wall = _run_process(cmd, outbuf, errbuf, *args, **kwargs)
+        if TIMINGS is not None or TIMING_TOTALS is not None:
+            record_timing(command, start, wall, ru, process.returncode)
+
         if process.returncode == 0:
             logging.info(f'Running {command} succeeded')
+        elif timed_out:
+            logger.error(f'Timeout when running "{command}" after {wall:.1f}s')
         else:
             logger.error(f'Error when running "{command}", return code={process.returncode}')
 
-        if hout: output = safe_read(outfile).decode('utf-8')
-        if herr: errors = safe_read(errfile).decode('utf-8')
+        # truncated output may split characters
+        if hout: output = safe_read(outfile).decode('utf-8', errors='replace')
+        if herr: errors = safe_read(errfile).decode('utf-8', errors='replace')
+
+        if outbuf:
+            output = outbuf.getvalue().decode('utf-8', errors='replace')
+            outfile = outbuf.spillfile
+
+        if errbuf:
+            errors = errbuf.getvalue().decode('utf-8', errors='replace')
+            errfile = errbuf.spillfile
 
         return RunResult(success = process.returncode == 0,
                          returncode=process.returncode,
@@ -86,7 +524,11 @@ def run(cmd, *args, **kwargs):
                          errors=errors,
                          outfile=outfile,
                          errfile=errfile,
-                         exception=None)
+                         exception=None,
+                         timed_out=timed_out,
+                         cpu_time=ru.ru_utime + ru.ru_stime,
+                         max_rss=ru.ru_maxrss,
+                         wall_time=wall)
     except Exception as e:
         logger.error(f'Error when running "{command}"', exc_info = e)
         return RunResult(success = False, returncode=None, output=None, exception=e,
@@ -100,14 +542,83 @@ def run(cmd, *args, **kwargs):
             os.close(herr)
             os.unlink(errfile)
 
+        if outbuf: outbuf.close()
+        if errbuf: errbuf.close()
+
     assert False
 
-def run_timeout(timeout_s, cmd, *args, **kwargs):
-    command = ['timeout', f'{timeout_s}s'] + cmd
-    logger.info(f"Running {command}")
-    x = run(command, *args, **kwargs)
-    if x.returncode == 124:
-        #x.output = x.output + "*** TIMEOUT ***\n"
-        pass
+def run_timeout(timeout_s, cmd, *args, limits = None, **kwargs):
+    """Run cmd, killing it and all its descendants after timeout_s
+       seconds of wall-clock time.
+
+       limits is a dictionary of resource limits (see RLIMITS) that
+       is applied on top of DEFAULT_LIMITS.
+
+       On a timeout, the result has timed_out set, and returncode is
+       TIMEOUT_RETURNCODE for compatibility with timeout(1).
+
+       If BUDGET is set, timeout_s is reduced to fit in the remaining
+       time budget, and once it is exhausted, commands are not run at
+       all and return a timed out result."""
 
-    return x
+    lim = dict(DEFAULT_LIMITS)
+    if limits: lim.update(limits)
+
+    if BUDGET is not None:
+        timeout_s = BUDGET.timeout(timeout_s)
+        if timeout_s <= 0:
+            logger.error(f'Not running {cmd}, time budget exhausted')
+            return RunResult(success = False,
+                             returncode = TIMEOUT_RETURNCODE,
+                             output = "",
+                             errors = "*** NOT RUN: time budget exhausted",
+                             exception = None,
+                             processobj = None,
+                             outfile = None,
+                             errfile = None,
+                             timed_out = True)
+
+    logger.info(f"Running {cmd} with timeout {timeout_s}s, limits {lim}")
+    return run(cmd, *args, wall_timeout=timeout_s, limits=lim, **kwargs)
+
+def run_many(cmds, *args, concurrency = None, timeout_s = None, **kwargs):
+    """Run independent commands in parallel, at most concurrency at a
+       time (default: number of CPUs).
+
+       Each element of cmds is either a command (a list), or a Command
+       with its own keyword arguments and timeout, which override
+       kwargs and timeout_s. Commands with a timeout are run with
+       run_timeout.
+
+       Returns an iterator over the RunResults in the same order as
+       cmds. Results are produced as soon as all preceding commands
+       have finished. Commands that have not started are cancelled if
+       the iterator is closed early or raises."""
+
+    def run_one(c):
+        if not isinstance(c, Command):
+            c = Command(c)
+
+        kw = dict(kwargs)
+        if c.kwargs: kw.update(c.kwargs)
+
+        t = c.timeout_s if c.timeout_s is not None else timeout_s
+        if t is not None:
+            return run_timeout(t, c.cmd, *args, **kw)
+        else:
+            return run(c.cmd, *args, **kw)
+
+    import concurrent.futures
+
+    if concurrency is None:
+        concurrency = os.cpu_count() or 1
+
+    ex = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = [ex.submit(run_one, c) for c in cmds]
+        for f in futures:
+            yield f.result()
+    finally:
+        # on an exception (e.g. BudgetExpired) or if the caller stops
+        # early, don't start the commands that are still queued
+        ex.shutdown(wait=True, cancel_futures=True)
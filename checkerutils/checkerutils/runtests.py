@@ -10,13 +10,22 @@
 
 import tempfile
 import os
-from . import cbmc_trace
 import types
 from . import runner
 import logging
 
 logger = logging.getLogger(__name__)
 
+# if set, CBMCRunTest.get_trace appends counterexamples to this CSV file
+# (see cbmc_trace.write_counterexamples)
+COUNTEREXAMPLES = None
+
+# submission id written in each counterexample row
+SUBMISSION = ''
+
+# if set to a GSResults, it is checkpointed after each RunTest is processed
+RESULTS = None
+
 def get_temp_file(suffix=None,prefix=None,dir=None,text=False,close=True):
     h, n = tempfile.mkstemp(suffix=suffix, prefix=prefix,dir=dir,text=text)
     if close:
@@ -25,8 +34,25 @@ def get_temp_file(suffix=None,prefix=None,dir=None,text=False,close=True):
     else:
         return h, n
 
+def get_cbmc_trace(rt):
+    """Return the parsed CBMC output of RunTest rt, reading it only once.
+
+       If rt.args has a 'src' entry, recorded assignments are kept for
+       get_trace."""
+
+    if getattr(rt, 'cj', None) is None:
+        from . import cbmc_trace # imported lazily, only CBMC tests need it
+
+        if rt.args.get('src', None):
+            rt.cj = cbmc_trace.open_trace(rt.args['json'], rt.args['src'],
+                                          rows = COUNTEREXAMPLES is not None)
+        else:
+            rt.cj = cbmc_trace.CBMCTrace(jsonfile=rt.args['json'], traces=False)
+
+    return rt.cj
+
 def cbmc_debug_output(self):
-    cj = cbmc_trace.CBMCTrace(jsonfile=self.args['json'])
+    cj = get_cbmc_trace(self)
 
     out = []
     for e in cj.get_errors():
@@ -87,6 +113,11 @@ class RunTest(object):
         return self.rr.errors
 
     def process(self):
+        ok = self._process()
+        if RESULTS is not None: RESULTS.checkpoint()
+        return ok
+
+    def _process(self):
         if self.rr.success:
             self.test.add_output(f'PASS: {self.stt}')
             # maybe add success output?
@@ -109,7 +140,7 @@ class RunTest(object):
                 do = self.debug_output()
                 if do: self.test.add_output(do)
 
-                if self.rr.returncode == 124:
+                if self.rr.timed_out:
                     self.test.add_output(f'*** TIMEOUT')
 
             return False
@@ -118,10 +149,7 @@ class CBMCRunTest(RunTest):
     cj = None
 
     def get_runner_output_for_log(self):
-        if not self.cj:
-            self.cj = cbmc_trace.CBMCTrace(jsonfile=self.args['json'])
-
-        text = self.cj.json_to_text()
+        text = get_cbmc_trace(self).json_to_text()
         return ">>>=== CBMC Output ===<<<\n" + runner.shorten("\n".join(text), self.max_output) + "\n>>>=== CBMC Output End ===<<<"
 
     def get_runner_errors_for_log(self):
@@ -129,28 +157,76 @@ class CBMCRunTest(RunTest):
         return runner.shorten(self.rr.errors, self.max_output)
 
     def debug_output(self):
-        if self.rr.returncode == 124:
+        if self.rr.timed_out:
             # timeout
             return ""
 
-        if not self.cj:
-            self.cj = cbmc_trace.CBMCTrace(jsonfile=self.args['json'])
+        cj = get_cbmc_trace(self)
 
         out = []
-        for e in self.cj.get_errors():
+        for e in cj.get_errors():
             out.append(f"    ERROR: {e['messageText']}")
 
-        for r in self.cj.get_results(assert_on_missing=False):
+        for r in cj.get_results(assert_on_missing=False):
             out.append(f"    {r['status']}: {r['description']}")
 
         return "\n".join(out)
 
     def get_trace(self):
-        if self.rr.returncode == 124:
+        if self.rr.timed_out:
             return []
 
-        x = cbmc_trace.get_trace(self.args['json'], self.args['src'])
-        return x
+        from . import cbmc_trace
+
+        cj = get_cbmc_trace(self)
+        if COUNTEREXAMPLES is not None:
+            cbmc_trace.write_counterexamples(cj, COUNTEREXAMPLES, self.stt, SUBMISSION)
+
+        return cbmc_trace.trace_to_results(cj)
+
+class RunTestBatch(object):
+    """Runs the commands of several RunTests in parallel.
+
+       Tests are added with add(), and run() then runs all their
+       commands (using runner.run_many) and processes the RunTests in
+       the order they were added, so that output is appended to the
+       Gradescope tests in a deterministic order, regardless of which
+       command finishes first.
+
+       If results (a GSResults) is provided, each Gradescope test is
+       also added to it, in order, if it is not already there.
+    """
+
+    def __init__(self, concurrency = None, results = None):
+        self.concurrency = concurrency
+        self.results = results
+        self.pending = []
+
+    def add(self, test, sub_test_title, cmd, timeout_s = None,
+            runtest_class = RunTest, internal_error = None,
+            debug_output = None, args = None, **kwargs):
+        """Add a test that runs cmd, with kwargs passed to runner.run"""
+        self.pending.append((runner.Command(cmd, kwargs, timeout_s),
+                             (runtest_class, test, sub_test_title,
+                              internal_error, debug_output, args)))
+
+    def run(self):
+        """Run all pending tests, returning the result of each
+           RunTest.process(), in the order they were added."""
+
+        pending, self.pending = self.pending, []
+        out = []
+
+        rrs = runner.run_many([c for c, _ in pending], concurrency=self.concurrency)
+        for rr, (_, (cls, test, stt, ie, do, args)) in zip(rrs, pending):
+            if self.results is not None and test not in self.results.tests:
+                self.results.add_test(test)
+
+            rt = cls(test, stt, rr, internal_error = ie, debug_output = do, args = args)
+            out.append(rt.process())
+
+        if self.results is not None: self.results.checkpoint()
+        return out
 
 if __name__ == "__main__":
     import gs
@@ -0,0 +1,42 @@
+import os
+import sys
+import signal
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from checkerutils import runner
+
+class KillOnOutputLimitTest(unittest.TestCase):
+    def test_kills_descendants_of_shell(self):
+        # yes is a grandchild that holds the pipe open, not the direct child
+        pidfile = tempfile.mktemp()
+        start = time.monotonic()
+        r = runner.run(['sh', '-c', f'yes & echo $! > {pidfile}; wait'],
+                       output_limit=100, kill_on_output_limit=True)
+
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertFalse(r.success)
+        self.assertIn("OUTPUT LIMIT EXCEEDED", r.output)
+
+        with open(pidfile) as f:
+            pid = int(f.read())
+        os.unlink(pidfile)
+
+        # the group was killed, so yes is gone (or a zombie waiting to be reaped)
+        for _ in range(100):
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    if f.read().rsplit(")", 1)[1].split()[0] == "Z":
+                        break
+            except FileNotFoundError:
+                break
+            time.sleep(0.05)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            self.fail("yes was left running")
+
+if __name__ == "__main__":
+    unittest.main()
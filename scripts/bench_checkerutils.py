@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+#
+# bench_checkerutils.py
+#
+# Benchmarks for the parts of checkerutils that grading spends most of
+# its time in, using synthetic inputs and a stub cbmc, so that they
+# can be run on any Linux machine.
+#
+# Reports the median time and the peak (Python) memory of each
+# benchmark, and can save them as JSON to compare revisions.
+
+import argparse
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "checkerutils"))
+
+from checkerutils import runner, gs, cbmc_trace
+
+FUNC_LINES = 9 # lines in each function generated by gen_c_source
+RECORD_LINE = 5 # line of the recorded assignment in each function
+
+def gen_c_source(nfuncs, annotate = True):
+    out = []
+    for i in range(nfuncs):
+        out.append(f"int f{i}(int x) {{")
+        out.append(f"  //@begin f{i}" if annotate else "")
+        out.append("  int y = x;")
+        out.append("  //@record" if annotate else "")
+        out.append(f"  y = y + {i};")
+        out.append("  if (y > 3) return y;")
+        out.append('  printf("%d", y);')
+        out.append("  return x;")
+        out.append("}")
+
+    out.append("int main(void) { return f0(1); }")
+    return "\n".join(out) + "\n"
+
+def gen_cbmc_json(srcfile, nprops, nsteps, nfuncs):
+    """CBMC JSON output with nprops failed properties, each with a trace
+       of about nsteps steps through functions of gen_c_source"""
+
+    results = []
+    for p in range(nprops):
+        trace = []
+        while len(trace) < nsteps:
+            f = len(trace) % nfuncs
+            loc = {"file": srcfile, "line": str(RECORD_LINE + FUNC_LINES * f), "function": f"f{f}"}
+            trace.append({"hidden": False, "stepType": "function-call",
+                          "function": {"displayName": f"f{f}"}})
+            for j in range(4):
+                trace.append({"hidden": j % 2 == 1, "stepType": "assignment",
+                              "assignmentType": "variable", "lhs": f"y{j}",
+                              "value": {"data": str(j), "binary": format(j, "032b")},
+                              "sourceLocation": loc})
+            trace.append({"hidden": False, "stepType": "function-return",
+                          "function": {"displayName": f"f{f}"}})
+
+        results.append({"property": f"main.assertion.{p}", "description": "assertion y > 0",
+                        "status": "FAILURE", "trace": trace})
+
+    return [{"program": "CBMC 5.95.1 (stub)"},
+            {"messageType": "STATUS-MESSAGE", "messageText": f"Parsing {srcfile}"},
+            {"result": results},
+            {"cProverStatus": "failure"}]
+
+def gen_pp_yaml(nfuncs):
+    out = ["transformers:",
+           "  - name: PostconditionTransformer",
+           "    function: f0",
+           "    condition: y > 0",
+           "  - name: PreconditionTransformer",
+           "    function: f1",
+           "    condition: x > 0",
+           "  - name: PrintfTransformer",
+           "insert_at_exit:"]
+
+    for i in range(nfuncs):
+        out.append(f"  - function_name: f{i}")
+        out.append(f"    code: \"x = x + {i};\"")
+
+    out.extend(["template:",
+                "  pre: \"int printfX(const char *f, ...);\"",
+                "cbmc:",
+                "  cstd: c99",
+                "  unwind: 5"])
+
+    return "\n".join(out) + "\n"
+
+STUB_CBMC = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "5.95.1 (stub)"; exit 0; fi
+cat "$STUB_CBMC_OUTPUT"
+exit 10
+"""
+
+def write(path, data):
+    with open(path, "w") as f:
+        f.write(data)
+
+    return path
+
+# each benchmark takes a scratch directory and a scale, and returns the
+# function to time
+
+def bench_run(tmpdir, scale, capture):
+    size = int(64 * 1024 * 1024 * scale)
+    cmd = ['sh', '-c', f"head -c {size} /dev/zero | tr '\\0' x"]
+    return lambda: runner.run(cmd, capture=capture)
+
+def bench_run_limited(tmpdir, scale):
+    size = int(64 * 1024 * 1024 * scale)
+    cmd = ['sh', '-c', f"head -c {size} /dev/zero | tr '\\0' x"]
+    return lambda: runner.run(cmd, output_limit=64*1024)
+
+def _trace_fixture(tmpdir, scale):
+    nfuncs = 50
+    src = write(os.path.join(tmpdir, "trace.c"), gen_c_source(nfuncs))
+    jf = os.path.join(tmpdir, "trace.json")
+    if not os.path.exists(jf):
+        with open(jf, "w") as f:
+            json.dump(gen_cbmc_json(src, max(1, int(20 * scale)), int(20000 * scale), nfuncs), f)
+
+    return src, jf
+
+def bench_cbmctrace(tmpdir, scale):
+    src, jf = _trace_fixture(tmpdir, scale)
+    return lambda: cbmc_trace.CBMCTrace(jsonfile=jf).get_results()
+
+def bench_get_trace(tmpdir, scale):
+    src, jf = _trace_fixture(tmpdir, scale)
+    return lambda: cbmc_trace.get_trace(jf, src)
+
+def bench_astransformer(tmpdir, scale):
+    from checkerutils import cxform
+
+    code = gen_c_source(max(1, int(500 * scale)), annotate=False)
+    xf = [cxform.PostconditionTransformer({'function': 'f0', 'condition': 'y > 0'}),
+          cxform.PreconditionTransformer({'function': 'f1', 'condition': 'x > 0'}),
+          cxform.PrintfTransformer()]
+
+    return lambda: cxform.ASTTransformer(xf).transform_string(code)
+
+def bench_preprocessor(tmpdir, scale):
+    from checkerutils import check_cbmc
+
+    nfuncs = max(2, int(500 * scale))
+    src = write(os.path.join(tmpdir, "pp.c"), gen_c_source(nfuncs))
+    ppf = write(os.path.join(tmpdir, "pp.yml"), gen_pp_yaml(nfuncs))
+
+    def run():
+        with open(os.devnull, "w") as null:
+            x = check_cbmc.Preprocessor(ppf, err=null)
+            x.set_input(src)
+            x.get_output()
+
+    return run
+
+def bench_check_cbmc(tmpdir, scale):
+    from checkerutils import check_cbmc
+
+    src, jf = _trace_fixture(tmpdir, scale)
+    ppf = write(os.path.join(tmpdir, "pp.yml"), gen_pp_yaml(2))
+
+    bindir = os.path.join(tmpdir, "bin")
+    os.makedirs(bindir, exist_ok=True)
+    os.chmod(write(os.path.join(bindir, "cbmc"), STUB_CBMC), 0o755)
+    out = os.path.join(tmpdir, "check_cbmc.json")
+
+    # the stub cbmc is only on PATH while the benchmark runs
+    def run():
+        saved = {k: os.environ.get(k) for k in ["PATH", "STUB_CBMC_OUTPUT"]}
+        os.environ["PATH"] = bindir + os.pathsep + saved["PATH"]
+        os.environ["STUB_CBMC_OUTPUT"] = jf
+        check_cbmc.cbmc_version.cache_clear()
+        try:
+            check_cbmc.check_cbmc(src, ppf, json_ui=True, quiet=True, output=out, cache="")
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+            check_cbmc.cbmc_version.cache_clear()
+
+    return run
+
+def bench_results_json(tmpdir, scale):
+    ntests = max(1, int(5000 * scale))
+
+    def run():
+        r = gs.GSResults(os.path.join(tmpdir, "results.json"))
+        r.score = 0
+        for i in range(ntests):
+            t = gs.GSTest(f"test {i}", i % 2, 1)
+            t.add_output(f"PASS: subtest {i}")
+            t.add_output("x" * 200)
+            if i % 10 == 0: t.visibility = gs.VIS_AFTER_DUE_DATE
+            r.add_test(t)
+
+        r.get_results_json()
+        r.write()
+
+    return run
+
+BENCHMARKS = [('runner.run (file)', lambda d, s: bench_run(d, s, runner.CAPTURE_FILE)),
+              ('runner.run (pipe)', lambda d, s: bench_run(d, s, runner.CAPTURE_PIPE)),
+              ('runner.run (output_limit)', bench_run_limited),
+              ('CBMCTrace', bench_cbmctrace),
+              ('get_trace', bench_get_trace),
+              ('ASTTransformer', bench_astransformer),
+              ('Preprocessor.get_output', bench_preprocessor),
+              ('check_cbmc', bench_check_cbmc),
+              ('GSResults.get_results_json', bench_results_json),
+              ]
+
+def measure(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'median_s': statistics.median(times),
+            'min_s': min(times),
+            'peak_bytes': peak}
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Benchmark checkerutils")
+    p.add_argument("benchmarks", nargs="*", help="Benchmarks to run (default: all), matched by prefix")
+    p.add_argument("-n", dest="repeat", type=int, default=3, help="Number of timed runs of each benchmark")
+    p.add_argument("-s", dest="scale", type=float, default=1.0, help="Scale the size of the inputs")
+    p.add_argument("-o", dest="output", help="Write results as JSON to this file")
+    p.add_argument("-b", dest="baseline", help="JSON file from a previous run to compare against")
+    p.add_argument("-l", dest="list", action="store_true", help="List benchmarks")
+
+    args = p.parse_args()
+
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        sys.exit(0)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)['results']
+
+    tmpdir = tempfile.mkdtemp(prefix="bench-")
+    results = {}
+    try:
+        print(f"{'benchmark':30s} {'median (s)':>11s} {'peak (MB)':>10s} {'vs base':>8s}")
+        for name, bench in BENCHMARKS:
+            if args.benchmarks and not any(name.startswith(b) for b in args.benchmarks):
+                continue
+
+            r = measure(bench(tmpdir, args.scale), args.repeat)
+            results[name] = r
+
+            change = ""
+            if name in baseline:
+                change = f"{r['median_s'] / baseline[name]['median_s']:.2f}x"
+
+            print(f"{name:30s} {r['median_s']:11.3f} {r['peak_bytes'] / 1e6:10.1f} {change:>8s}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'revision': revision(),
+                       'python': sys.version,
+                       'scale': args.scale,
+                       'results': results}, f, indent=2)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# import_time.py
+#
+# Measure the startup cost of checkerutils modules (and optionally an
+# assignment's checker), so that regressions in import time can be
+# tracked locally.
+#
+# Each module is imported in a fresh interpreter several times with
+# `python -X importtime`, and the median self and cumulative import
+# times are reported.
+
+import argparse
+import subprocess
+import sys
+import os
+import json
+import statistics
+
+MODULES = ['checkerutils.gs', 'checkerutils.runner', 'checkerutils.runtests',
+           'checkerutils.cbmc_trace', 'checkerutils.check_cbmc',
+           'checkerutils.testhelper']
+
+def import_time(module, env):
+    """Return the self and cumulative import times of module (and all
+       the modules it imports) in microseconds, from a fresh interpreter."""
+
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env,
+                       check=True)
+
+    out = {}
+    for l in p.stderr.decode('utf-8').splitlines():
+        if not l.startswith("import time:") or "|" not in l:
+            continue
+
+        selft, cumul, name = l[len("import time:"):].split("|")
+        if selft.strip() == "self [us]": continue # header
+
+        out[name.strip()] = (int(selft), int(cumul))
+
+    return out
+
+def measure(modules, runs, env):
+    results = {}
+    for m in modules:
+        samples = [import_time(m, env) for _ in range(runs)]
+        results[m] = {'self_us': statistics.median([s[m][0] for s in samples]),
+                      'cumulative_us': statistics.median([s[m][1] for s in samples]),
+                      # every module imported as a result
+                      'imports': sorted(n for n in samples[-1] if n != m)}
+
+    return results
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Measure the import time of checkerutils modules")
+    p.add_argument("modules", nargs="*", help="Modules to measure (default: all checkerutils modules)")
+    p.add_argument("-a", dest="assignment", help="Assignment directory, to also measure its checker module")
+    p.add_argument("-n", dest="runs", type=int, default=5, help="Number of runs per module")
+    p.add_argument("-o", dest="output", help="Write results as JSON to this file")
+    p.add_argument("-b", dest="baseline", help="JSON file from a previous run to compare against")
+
+    args = p.parse_args()
+
+    modules = args.modules or list(MODULES)
+
+    env = dict(os.environ)
+    paths = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "checkerutils")]
+    if args.assignment:
+        paths.append(args.assignment)
+        modules.append('checker')
+
+    env['PYTHONPATH'] = os.pathsep.join(paths + [env.get('PYTHONPATH', '')])
+
+    results = measure(modules, args.runs, env)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    print(f"{'module':40s} {'self (ms)':>10s} {'cumul (ms)':>11s} {'change':>8s}")
+    for m, r in results.items():
+        change = ""
+        if m in baseline:
+            change = f"{(r['cumulative_us'] - baseline[m]['cumulative_us']) / 1000:+.1f}"
+
+        print(f"{m:40s} {r['self_us'] / 1000:10.1f} {r['cumulative_us'] / 1000:11.1f} {change:>8s}")
+
+    for m in ['yaml', 'pycparser']:
+        pulled = [x for x in results if m in results[x]['imports']]
+        if pulled: print(f"{m} is imported by {', '.join(pulled)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
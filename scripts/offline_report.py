@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# offline_report.py
+#
+# Summarize an offline regrade (see run_offline.py) and compare it to the
+# original Gradescope results in the submission export.
+
+import argparse
+import os
+import re
+import csv
+import json
+import concurrent.futures
+
+from run_offline import ExportMetadata
+
+# files written by run_autograder_offline_auto
+RUN_RE = re.compile(r'^(?P<sid>.+)-(?P<run>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)\.(?P<kind>log|results\.json)$')
+
+def find_runs(offlined):
+    """Return the latest run of each submission in offlined, as a
+       dictionary of submission id -> (run, results.json file or None)"""
+
+    latest = {}
+    for e in os.scandir(offlined):
+        m = RUN_RE.match(e.name)
+        if not m:
+            continue
+
+        sid, run = m['sid'], m['run']
+        if sid not in latest or run > latest[sid][0]:
+            latest[sid] = (run, None)
+
+        if m['kind'] == 'results.json' and latest[sid][0] == run:
+            latest[sid] = (run, e.path)
+
+    return latest
+
+def summarize_results(r):
+    """Return the total score and the (score, status) of each test in a
+       results.json dictionary"""
+
+    tests = {}
+    for t in r.get('tests', []):
+        tests[t.get('name')] = (t.get('score'), t.get('status'))
+
+    score = r.get('score')
+    if score is None:
+        score = sum(s for s, _ in tests.values() if s is not None)
+
+    return {'score': float(score), 'tests': tests}
+
+def summarize_file(resultsfile):
+    with open(resultsfile, "r") as f:
+        return summarize_results(json.load(f))
+
+def test_changes(old, new):
+    """Return the (name, old, new) (score, status) of tests that differ"""
+
+    out = []
+    for name in new['tests']:
+        o = old['tests'].get(name, (None, None))
+        if o != new['tests'][name]:
+            out.append((name, o, new['tests'][name]))
+
+    for name in old['tests']:
+        if name not in new['tests']:
+            out.append((name, old['tests'][name], (None, None)))
+
+    return out
+
+def format_test(t):
+    score, status = t
+    out = f"{score:g}" if score is not None else "-"
+    return out + f" ({status})" if status else out
+
+def build_report(exportdir, offlined, jobs = None):
+    """Return a list of rows, one per regraded submission, each with its
+       submitters, original and regraded summaries, and changed tests."""
+
+    runs = find_runs(offlined)
+    sids = sorted(runs)
+
+    # parse results files in parallel
+    files = [runs[s][1] for s in sids if runs[s][1] is not None]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as ex:
+        summaries = dict(zip(files, ex.map(summarize_file, files, chunksize=32)))
+
+    smd = ExportMetadata(exportdir)
+
+    rows = []
+    for sid in sids:
+        run, rf = runs[sid]
+        new = summaries[rf] if rf is not None else None
+
+        try:
+            md = smd.get(sid)
+            submitters = [x.get(':name', '') for x in md.get(':submitters', [])]
+            old = summarize_results(md[':results']) if md.get(':results') else None
+        except KeyError:
+            submitters = []
+            old = None
+
+        changes = test_changes(old, new) if old is not None and new is not None else []
+        rows.append({'sid': sid, 'run': run, 'submitters': submitters,
+                     'old': old, 'new': new, 'changes': changes})
+
+    return rows
+
+def write_summary(rows, csvfile):
+    """Write one row per submission and one column per test (with the
+       regraded score of that test)"""
+
+    tests = {}
+    for r in rows:
+        if r['new'] is not None:
+            tests.update(dict.fromkeys(r['new']['tests']))
+
+    with open(csvfile, "w", newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['submission', 'submitters', 'run', 'old_score', 'new_score', 'delta', 'changed_tests'] + list(tests))
+
+        for r in rows:
+            old = r['old']['score'] if r['old'] is not None else None
+            new = r['new']['score'] if r['new'] is not None else None
+            delta = new - old if old is not None and new is not None else None
+            nt = r['new']['tests'] if r['new'] is not None else {}
+
+            w.writerow([r['sid'], "; ".join(r['submitters']), r['run'], old, new, delta,
+                        "; ".join(c[0] for c in r['changes'])] +
+                       [nt[t][0] if t in nt else None for t in tests])
+
+def print_report(rows, all_changes = False):
+    missing = [r for r in rows if r['new'] is None]
+    changed = [r for r in rows if r['old'] is not None and r['new'] is not None
+               and (r['new']['score'] != r['old']['score'] or (all_changes and r['changes']))]
+
+    up = sum(1 for r in changed if r['new']['score'] > r['old']['score'])
+    down = sum(1 for r in changed if r['new']['score'] < r['old']['score'])
+
+    changed.sort(key=lambda r: (-abs(r['new']['score'] - r['old']['score']), r['sid']))
+    for r in changed:
+        old, new = r['old']['score'], r['new']['score']
+        print(f"{r['sid']} ({', '.join(r['submitters'])}): {old:g} -> {new:g} ({new - old:+g})")
+        for name, o, n in r['changes']:
+            print(f"    {name}: {format_test(o)} -> {format_test(n)}")
+
+    print(f"{len(rows)} submissions regraded: {up} scores up, {down} down, {len(missing)} without results")
+    if missing:
+        print(f"No results: {' '.join(r['sid'] for r in missing)}")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Compare an offline regrade to the original Gradescope results")
+    p.add_argument("exportdir", help="Gradescope submission export directory")
+    p.add_argument("offlinedir", help="Directory containing the offline results (see run_offline.py)")
+    p.add_argument("-o", dest="output", help="Write a CSV summary (one row per submission, one column per test) to this file")
+    p.add_argument("-j", dest="jobs", type=int, help="Number of processes used to read results")
+    p.add_argument("-a", dest="all_changes", action="store_true", help="Also report submissions whose total score did not change, but whose tests did")
+
+    args = p.parse_args()
+
+    rows = build_report(args.exportdir, args.offlinedir, args.jobs)
+    print_report(rows, args.all_changes)
+
+    if args.output:
+        write_summary(rows, args.output)
@@ -18,6 +18,11 @@ import json
 from datetime import datetime, timedelta
 import yaml
 import glob
+import signal
+import stat
+import time
+import concurrent.futures
+import sqlite3
 
 def smd_dummy():
     smd = {'id': 1,
@@ -73,7 +78,80 @@ def smd_from_export(smd_export, submission_id):
 
     return smd
 
-def create_autograder_env(archive, submission, metadata):
+def extract_autograder_base(archive):
+    """Extract the autograder archive once into a base tree, which is
+       then cloned for each submission by clone_tree."""
+
+    base = tempfile.mkdtemp(prefix="agbase-")
+    subprocess.check_call(['unzip', '-q', archive, '-d', base])
+
+    return base
+
+# directories that are modified in place (git appends to its logs and
+# rewrites FETCH_HEAD, etc.), and so are always copied, never hardlinked
+COPY_DIRS = ['.git']
+
+def clone_tree(src, dst, clone = 'hardlink'):
+    """Populate dst (which must exist) with the contents of src.
+
+       clone is one of 'hardlink' (hardlink farm, directories are
+       recreated), 'reflink' (copy-on-write copy where the filesystem
+       supports it, plain copy otherwise) or 'copy'.
+
+       Hardlinked files are made read-only, so that a checker writing
+       in place into one fails loudly instead of corrupting the base for
+       every other submission. Directories in COPY_DIRS are copied even
+       when hardlinking."""
+
+    if clone == 'reflink':
+        subprocess.check_call(['cp', '-a', '--reflink=auto', os.path.join(src, '.'), dst])
+        return
+
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, start=src)
+        droot = os.path.join(dst, rel) if rel != '.' else dst
+
+        for d in list(dirs):
+            s = os.path.join(root, d)
+            if os.path.islink(s):
+                os.symlink(os.readlink(s), os.path.join(droot, d))
+            elif clone == 'hardlink' and d in COPY_DIRS:
+                shutil.copytree(s, os.path.join(droot, d), symlinks=True)
+                dirs.remove(d)
+            else:
+                os.mkdir(os.path.join(droot, d))
+                shutil.copymode(s, os.path.join(droot, d))
+
+        for f in files:
+            s = os.path.join(root, f)
+            d = os.path.join(droot, f)
+            if os.path.islink(s):
+                os.symlink(os.readlink(s), d)
+            elif clone == 'hardlink':
+                try:
+                    os.link(s, d)
+                except OSError:
+                    # e.g. base tree on a different filesystem
+                    shutil.copy2(s, d)
+                    continue
+
+                # the mode is shared with the base, so this only changes
+                # it the first time the file is linked
+                st = os.stat(d)
+                if st.st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+                    os.chmod(d, st.st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            else:
+                shutil.copy2(s, d)
+
+def create_autograder_env(archive, submission, metadata, clone = 'hardlink'):
+    """Create a new AGROOT for a submission.
+
+       archive is either the autograder zip file, or a base tree
+       produced by extract_autograder_base, which is then cloned.
+
+       submission is a zip file, or None to leave autograder/submission
+       empty for the caller to populate."""
+
     nd = tempfile.mkdtemp()
 
     agd = os.path.join(nd, "autograder")
@@ -85,8 +163,13 @@ def create_autograder_env(archive, submission, metadata):
     for i in [agd, srcd, subd, resd]:
         os.mkdir(i)
 
-    subprocess.check_call(['unzip', '-q', archive, '-d', srcd])
-    subprocess.check_call(['unzip', '-q', submission, '-d', subd])
+    if os.path.isdir(archive):
+        clone_tree(archive, srcd, clone)
+    else:
+        subprocess.check_call(['unzip', '-q', archive, '-d', srcd])
+
+    if submission is not None:
+        subprocess.check_call(['unzip', '-q', submission, '-d', subd])
 
     shutil.copy(os.path.join(srcd, "run_autograder"), agd)
 
@@ -104,10 +187,20 @@ def get_submission_metadata_yaml(json_smd):
 
     return yaml.dump(myaml)
 
-def update_autograder_offline(nd):
+def offline_env(nd, offlined = None):
+    env = dict(os.environ)
+    env["AGROOT"] = nd
+    if offlined is not None:
+        env["OFFLINE_AUTOGRADER"] = "1"
+        env["OFFLINE_PATH"] = offlined
+
+    return env
+
+def update_autograder_offline(nd, env = None):
     agd = os.path.join(nd, "autograder")
-    os.environ["AGROOT"] = nd
-    subprocess.check_call(["source/update.sh"], cwd=agd)
+    if env is None:
+        os.environ["AGROOT"] = nd
+    subprocess.check_call(["source/update.sh"], cwd=agd, env=env)
 
 def run_autograder(nd):
     agd = os.path.join(nd, "autograder")
@@ -147,42 +240,117 @@ def run_autograder_offline(nd, offlined):
         # you can reach here using `exit` in the shell or if the run_autograder script fails
         print(f"Return code={ret}, {agd} was not removed.")
 
-def run_autograder_offline_auto(nd, offlined, sid):
+def run_autograder_offline_auto(nd, offlined, sid, timeout = None, env = None):
     agd = os.path.join(nd, "autograder")
 
-    os.environ["AGROOT"] = nd
-    os.environ["OFFLINE_AUTOGRADER"] = "1"
-    os.environ["OFFLINE_PATH"] = offlined
+    if env is None:
+        env = offline_env(nd, offlined)
 
-    #hout, outputfile = tempfile.mkstemp()
+    # run in a new session so that a timeout kills the whole process group
+    p = subprocess.Popen(["./run_autograder"],
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT,
+                         cwd=agd, env=env, start_new_session=True)
 
+    timed_out = False
     try:
-        output = subprocess.check_output(["./run_autograder"],
-                                         stdin=subprocess.DEVNULL,
-                                         stderr=subprocess.STDOUT,
-                                         cwd=agd)
-    except CalledProcessError as e:
-        output = e.output
-
-    shutil.rmtree(nd)
+        try:
+            output, _ = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        finally:
+            # the new session doesn't get Ctrl-C either, so kill it (and
+            # anything it left running) however we leave
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+            if p.returncode is None and not timed_out:
+                p.wait()
+
+        if timed_out:
+            output, _ = p.communicate()
+            output += f"\n*** OFFLINE TIMEOUT after {timeout}s ***\n".encode('utf-8')
+
+        run = datetime.utcnow().isoformat(timespec='seconds')
+
+        # keep results.json for offline_report.py, and counterexamples (see
+        # run_checker) for offline analysis
+        for fn in ["results.json", "counterexamples.csv"]:
+            results = os.path.join(agd, "results", fn)
+            if os.path.exists(results):
+                shutil.copyfile(results, os.path.join(offlined, f"{sid}-{run}.{fn}"))
+    finally:
+        shutil.rmtree(nd)
 
-    run = datetime.utcnow().isoformat(timespec='seconds')
     with open(os.path.join(offlined, f"{sid}-{run}.log"), "wb") as f:
         f.write(output)
 
-def get_export_submissions_md(exportdir):
-    if os.path.exists(os.path.join(exportdir, "submission_metadata_lite.yml")):
-        fn = os.path.join(exportdir, "submission_metadata_lite.yml")
-        lite = True
-    else:
-        fn = os.path.join(exportdir, "submission_metadata.yml")
-        lite = False
+    return not timed_out
+
+def has_offline_log(offlined, sid):
+    return len(glob.glob(os.path.join(glob.escape(offlined), f"{glob.escape(str(sid))}-*.log"))) > 0
+
+def grade_submission_offline(archive, exportdir, offlined, sid, md, timeout = None, clone = 'hardlink', repack = False):
+    """Grade a single submission non-interactively in its own AGROOT.
+
+       Runs in a worker process, so must not touch os.environ."""
+
+    start = time.monotonic()
+    jsonmd = smd_from_export(md, int(sid))
+
+    nd = create_export_submission_env(archive, exportdir, sid, jsonmd, clone, repack)
+
+    env = offline_env(nd, offlined)
+    try:
+        update_autograder_offline(nd, env)
+    except BaseException:
+        shutil.rmtree(nd)
+        raise
+
+    # removes nd
+    completed = run_autograder_offline_auto(nd, offlined, sid, timeout, env)
+
+    return sid, completed, time.monotonic() - start
+
+def format_duration(s):
+    return str(timedelta(seconds=int(s)))
+
+def run_parallel_offline(archive, exportdir, offlined, smd, sids, jobs, timeout = None, clone = 'hardlink', repack = False):
+    total = len(sids)
+    done = 0
+    failed = []
+    start = time.monotonic()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as ex:
+        futures = {ex.submit(grade_submission_offline, archive, exportdir,
+                             offlined, sid, smd.get(sid), timeout, clone, repack): sid
+                   for sid in sids}
 
-    with open(fn) as f:
-        smd = yaml.safe_load(f)
-        return smd, lite
+        for fut in concurrent.futures.as_completed(futures):
+            sid = futures[fut]
+            done += 1
+
+            try:
+                _, completed, elapsed = fut.result()
+                status = "ok" if completed else "TIMEOUT"
+                if not completed: failed.append(sid)
+            except Exception as e:
+                status = f"ERROR ({e})"
+                elapsed = 0
+                failed.append(sid)
+
+            wall = time.monotonic() - start
+            eta = wall / done * (total - done)
+            print(f"[{done}/{total}] {sid}: {status} in {elapsed:.1f}s, elapsed {format_duration(wall)}, ETA {format_duration(eta)}", flush=True)
+
+    return failed
+
+def clean_smd_results(smd_export):
+    """Drop per-test output from a submission's export metadata, in place"""
 
-def gen_light_smd(smd, exportdir):
     def clean_results(r):
         if 'tests' not in r:
             return
@@ -194,17 +362,102 @@ def gen_light_smd(smd, exportdir):
             else:
                 del t['output']
 
-    for s in smd:
-        if ':history' in smd[s]:
-            for hs in smd[s][':history']:
-                 if ':results' in hs:
-                     clean_results(hs[':results'])
+    if ':history' in smd_export:
+        for hs in smd_export[':history']:
+             if ':results' in hs:
+                 clean_results(hs[':results'])
+
+    if ':results' in smd_export:
+        clean_results(smd_export[':results'])
+
+class ExportMetadata(object):
+    """Indexed store of a Gradescope export's submission metadata.
+
+       The first time an export is used, its submission_metadata.yml
+       (or the lite version, if present) is parsed once and converted
+       into an SQLite database in the export directory, keyed by
+       submission id. Later lookups only read the rows they need.
+
+       The database is rebuilt if the YAML file is newer than it."""
+
+    DB = "submission_metadata.sqlite"
+
+    def __init__(self, exportdir):
+        self.exportdir = exportdir
+        self.dbfile = os.path.join(exportdir, self.DB)
+
+        yml = self._source_yaml()
+        if yml is None and not os.path.exists(self.dbfile):
+            raise FileNotFoundError(f"No submission_metadata.yml or {self.DB} found in {exportdir}, is it a Gradescope submission export?")
+
+        if not os.path.exists(self.dbfile) or (yml is not None and os.path.getmtime(yml) > os.path.getmtime(self.dbfile)):
+            self.convert(yml)
+
+        self.db = sqlite3.connect(self.dbfile)
+
+    def _source_yaml(self):
+        for fn in ["submission_metadata_lite.yml", "submission_metadata.yml"]:
+            fn = os.path.join(self.exportdir, fn)
+            if os.path.exists(fn):
+                return fn
+
+        return None
+
+    def convert(self, yml):
+        print(f"Indexing {yml} into {self.dbfile}")
+        with open(yml) as f:
+            smd = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+        tmpdb = self.dbfile + ".tmp"
+        if os.path.exists(tmpdb):
+            os.unlink(tmpdb)
+
+        def rows():
+            for k, md in smd.items():
+                clean_smd_results(md)
+                yield (k[len('submission_'):], ran_successfully(md),
+                       json.dumps(md.get(':submitters', []), default=str),
+                       json.dumps(md, default=str))
+
+        try:
+            db = sqlite3.connect(tmpdb)
+            try:
+                db.execute("CREATE TABLE submissions (id TEXT PRIMARY KEY, ran_successfully INTEGER, submitters TEXT, metadata TEXT)")
+                db.executemany("INSERT INTO submissions VALUES (?, ?, ?, ?)", rows())
+                db.commit()
+            finally:
+                db.close()
+
+            os.replace(tmpdb, self.dbfile)
+        finally:
+            # don't leave a partial database behind in the export
+            if os.path.exists(tmpdb):
+                os.unlink(tmpdb)
+
+    def ids(self):
+        return [r[0] for r in self.db.execute("SELECT id FROM submissions ORDER BY rowid")]
 
-        if ':results' in smd[s] :
-            clean_results(smd[s][':results'])
+    def _get(self, column, sid):
+        r = self.db.execute(f"SELECT {column} FROM submissions WHERE id = ?", (str(sid),)).fetchone()
+        if r is None:
+            raise KeyError(sid)
 
-        with open(os.path.join(exportdir, "submission_metadata_lite.yml"), "w") as f:
-            yaml.safe_dump(smd, f)
+        return r[0]
+
+    def get(self, sid):
+        """Return the export metadata for a submission, in the same form
+           as the YAML file (minus per-test output)."""
+        md = json.loads(self._get("metadata", sid))
+        if ':created_at' in md:
+            md[':created_at'] = datetime.fromisoformat(md[':created_at'])
+
+        return md
+
+    def submitters(self, sid):
+        return json.loads(self._get("submitters", sid))
+
+    def ran_successfully(self, sid):
+        return bool(self._get("ran_successfully", sid))
 
 def repack_export_submission(exportdir, subid, json_smd, output = None):
     if output is None:
@@ -229,6 +482,33 @@ def repack_export_submission(exportdir, subid, json_smd, output = None):
 
     return output
 
+def materialize_export_submission(exportdir, subid, json_smd, subd, clone = 'copy'):
+    """Copy an export's submission directory (plus metadata.yml) directly
+       into subd, without the zip round-trip of repack_export_submission.
+
+       The export must never be modified, so hardlinks are not used;
+       copies go through shutil.copy2, which uses in-kernel copies on
+       Linux."""
+
+    clone_tree(os.path.join(exportdir, f"submission_{subid}"), subd,
+               'reflink' if clone == 'reflink' else 'copy')
+
+    with open(os.path.join(subd, 'metadata.yml'), 'w') as f:
+        f.write(get_submission_metadata_yaml(json_smd))
+
+def create_export_submission_env(archive, exportdir, subid, json_smd, clone = 'hardlink', repack = False):
+    if repack:
+        submission = repack_export_submission(exportdir, subid, json_smd)
+        try:
+            return create_autograder_env(archive, submission, json_smd, clone)
+        finally:
+            os.unlink(submission)
+
+    nd = create_autograder_env(archive, None, json_smd, clone)
+    materialize_export_submission(exportdir, subid, json_smd,
+                                  os.path.join(nd, "autograder", "submission"), clone)
+    return nd
+
 def ran_successfully(metadata):
     if ':results' in metadata:
         if metadata[':results']['execution_time'] is not None:
@@ -241,6 +521,12 @@ if __name__ == "__main__":
     p = argparse.ArgumentParser(description="Run offline tests on submissions")
     p.add_argument("-n", dest="dryrun", action="store_true", help="Dry-run")
     p.add_argument("-a", dest="auto", action="store_true", help="Run automatically")
+    p.add_argument("-j", dest="jobs", type=int, default=1, help="Number of submissions to grade in parallel (implies -a)")
+    p.add_argument("-t", dest="timeout", type=int, help="Timeout in seconds for each submission when running automatically")
+    p.add_argument("-c", dest="clone", choices=['hardlink', 'reflink', 'copy', 'unzip'], default='hardlink',
+                   help="How to create each submission's autograder/source from the archive, which is extracted once (default: hardlink). 'unzip' extracts it for every submission")
+    p.add_argument("-z", dest="repack", action="store_true", help="Repack each submission into a zip file, as submitted to Gradescope, instead of copying it directly")
+    p.add_argument("-r", dest="resume", action="store_true", help="Skip submissions that already have a log in offlinedir")
     p.add_argument("archive", help="Autograder archive file")
     p.add_argument("exportdir", help="Gradescope submission export archive directory") #need to change this to be more general?
     p.add_argument("offlinedir", help="Directory to store offline results")
@@ -248,33 +534,60 @@ if __name__ == "__main__":
 
     args = p.parse_args()
 
-    smd, lite = get_export_submissions_md(args.exportdir)
-    if not lite:
-        print("generating lite version")
-        gen_light_smd(smd, args.exportdir)
+    if args.jobs > 1:
+        args.auto = True
+
+    smd = ExportMetadata(args.exportdir)
 
-    submission_ids = [k[len('submission_'):] for k in smd.keys()]
+    submission_ids = smd.ids()
     print(f"{len(submission_ids)} submissions found")
     if not len(args.submission_id):
         args.submission_id = submission_ids
 
     not_run = []
+    to_run = []
     for sid in args.submission_id:
-        md = smd[f'submission_{sid}']
-        if ran_successfully(md):
-            jsonmd = smd_from_export(md, int(sid))
-            if args.dryrun: continue
-
-            submission = repack_export_submission(args.exportdir, sid, jsonmd)
-            nd = create_autograder_env(args.archive, submission, jsonmd)
-            print(f"Autograder environment created in {nd}")
-            update_autograder_offline(nd)
-            if args.auto:
-                run_autograder_offline_auto(nd, args.offlinedir, sid)
-            else:
-                run_autograder_offline(nd, args.offlinedir)
+        if smd.ran_successfully(sid):
+            if args.resume and has_offline_log(args.offlinedir, sid):
+                print(f"Skipping {sid}, log already exists")
+                continue
+
+            to_run.append(sid)
         else:
             not_run.append(sid)
 
+    if args.dryrun:
+        print(f"Would run: {to_run}")
+        to_run = []
+
+    base = None
+    archive = args.archive
+    if len(to_run) and args.clone != 'unzip':
+        base = extract_autograder_base(args.archive)
+        archive = base
+        print(f"Autograder archive extracted to {base}")
+
+    try:
+        if args.jobs > 1:
+            failed = run_parallel_offline(archive, args.exportdir, args.offlinedir,
+                                          smd, to_run, args.jobs, args.timeout, args.clone, args.repack)
+            if len(failed) > 0:
+                print(f"Failed or timed out: {failed}")
+        else:
+            for sid in to_run:
+                jsonmd = smd_from_export(smd.get(sid), int(sid))
+
+                nd = create_export_submission_env(archive, args.exportdir, sid, jsonmd,
+                                                  args.clone, args.repack)
+                print(f"Autograder environment created in {nd}")
+                update_autograder_offline(nd)
+                if args.auto:
+                    run_autograder_offline_auto(nd, args.offlinedir, sid, args.timeout)
+                else:
+                    run_autograder_offline(nd, args.offlinedir)
+    finally:
+        if base is not None:
+            shutil.rmtree(base)
+
     if len(not_run) > 0:
         print(f"Did not run: {not_run}")
@@ -9,12 +9,18 @@
 # Copyright (C) 2019, Sreepathi Pai
 
 import argparse
+import sys
 import zipfile
 import tempfile
 import os
 import shutil
 import subprocess
 import json
+import time
+import queue
+import difflib
+import signal
+import concurrent.futures
 from datetime import datetime, timedelta
 
 def create_submission_metadata(p):
@@ -45,16 +51,11 @@ def create_submission_metadata(p):
     with open(os.path.join(p, 'submission_metadata.json'), 'w') as f:
         f.write(json.dumps(smd, indent=4))
 
-if __name__ == "__main__":
-    p = argparse.ArgumentParser(description="Test autograder submission")
-    p.add_argument("archive", help="Autograder archive file")
-    p.add_argument("submission", help="Student submission" )
-    p.add_argument("--sm", dest="metadata", help="Submission metadata file")
-
-    args = p.parse_args()
+def create_autograder_tree(archive):
+    """Create a temporary AGROOT with archive extracted into source/,
+       returning AGROOT"""
 
     nd = tempfile.mkdtemp()
-    print(nd)
 
     agd = os.path.join(nd, "autograder")
 
@@ -66,24 +67,261 @@ if __name__ == "__main__":
         os.mkdir(i)
 
     # these destroy permissions
-    #azip = zipfile.ZipFile(args.archive)
+    #azip = zipfile.ZipFile(archive)
     #azip.extractall(srcd)
 
-    #szip = zipfile.ZipFile(args.submission)
-    #szip.extractall(subd)
+    subprocess.check_call(['unzip', '-q', archive, '-d', srcd])
+    shutil.copy(os.path.join(srcd, "run_autograder"), agd)
 
-    subprocess.check_call(['unzip', '-q', args.archive, '-d', srcd])
+    return nd
 
-    if args.submission != "/dev/null":
-        subprocess.check_call(['unzip', '-q', args.submission, '-d', subd])
+def set_submission(nd, submission, metadata = None):
+    """Replace the submission (and results) in AGROOT nd"""
 
-    shutil.copy(os.path.join(srcd, "run_autograder"), agd)
+    agd = os.path.join(nd, "autograder")
+    subd = os.path.join(agd, "submission")
+    resd = os.path.join(agd, "results")
 
-    if args.metadata:
-        shutil.copyfile(args.metadata, os.path.join(agd, "submission_metadata.json"))
+    for d in [subd, resd]:
+        shutil.rmtree(d)
+        os.mkdir(d)
+
+    #szip = zipfile.ZipFile(submission)
+    #szip.extractall(subd)
+
+    if os.path.isdir(submission):
+        shutil.copytree(submission, subd, dirs_exist_ok=True, symlinks=True)
+    elif submission != "/dev/null":
+        subprocess.check_call(['unzip', '-q', submission, '-d', subd])
+
+    if metadata:
+        shutil.copyfile(metadata, os.path.join(agd, "submission_metadata.json"))
     else:
         create_submission_metadata(agd)
 
+# keys of results.json that change from run to run
+VOLATILE_KEYS = ['execution_time']
+VOLATILE_EXTRA_DATA = ['timing']
+
+def normalize_results(r):
+    r = dict(r)
+    for k in VOLATILE_KEYS:
+        r.pop(k, None)
+
+    if 'extra_data' in r:
+        r['extra_data'] = {k: v for k, v in r['extra_data'].items() if k not in VOLATILE_EXTRA_DATA}
+        if not r['extra_data']: del r['extra_data']
+
+    return r
+
+def diff_results(expected, actual):
+    """Return a list of the differences between two results.json dicts"""
+
+    expected = normalize_results(expected)
+    actual = normalize_results(actual)
+
+    out = []
+    for k in sorted(set(expected) | set(actual)):
+        if k == 'tests' or expected.get(k) == actual.get(k):
+            continue
+
+        if k == 'output':
+            out.extend(difflib.unified_diff(expected.get(k, '').splitlines(),
+                                            actual.get(k, '').splitlines(),
+                                            'expected output', 'actual output', lineterm=''))
+        else:
+            out.append(f"{k}: expected {expected.get(k)!r}, got {actual.get(k)!r}")
+
+    etests = {t.get('name'): t for t in expected.get('tests', [])}
+    atests = {t.get('name'): t for t in actual.get('tests', [])}
+
+    for name in etests:
+        if name not in atests:
+            out.append(f"test '{name}': missing")
+            continue
+
+        et, at = etests[name], atests[name]
+        for k in sorted(set(et) | set(at)):
+            if et.get(k) == at.get(k):
+                continue
+
+            if k == 'output':
+                out.append(f"test '{name}': output differs")
+                out.extend(difflib.unified_diff(et.get(k, '').splitlines(),
+                                                at.get(k, '').splitlines(),
+                                                'expected', 'actual', lineterm=''))
+            else:
+                out.append(f"test '{name}': {k}: expected {et.get(k)!r}, got {at.get(k)!r}")
+
+    for name in atests:
+        if name not in etests:
+            out.append(f"test '{name}': unexpected")
+
+    return out
+
+def find_submissions(subdir):
+    """Return (name, path) of each submission (a zip file or a directory)
+       in subdir"""
+
+    out = []
+    for e in sorted(os.scandir(subdir), key=lambda e: e.name):
+        if e.is_dir():
+            out.append((e.name, e.path))
+        elif e.name.endswith(".zip"):
+            out.append((e.name[:-len(".zip")], e.path))
+
+    return out
+
+def run_submission(trees, archive, name, submission, expecteddir, logdir, timeout, update):
+    # None is a tree that must be (re-)extracted
+    nd = trees.get()
+    timed_out = False
+    try:
+        if nd is None:
+            nd = create_autograder_tree(archive)
+
+        agd = os.path.join(nd, "autograder")
+        metadata = os.path.join(expecteddir, f"{name}.metadata.json")
+        set_submission(nd, submission, metadata if os.path.exists(metadata) else None)
+
+        env = dict(os.environ)
+        env["AGROOT"] = nd
+
+        start = time.monotonic()
+        with open(os.path.join(logdir, f"{name}.log"), "wb") as log:
+            # run in a new session so that a timeout kills the whole process group
+            p = subprocess.Popen([os.path.join(agd, "run_autograder")], cwd=agd, env=env,
+                                 stdout=log, stderr=subprocess.STDOUT,
+                                 stdin=subprocess.DEVNULL, start_new_session=True)
+            try:
+                p.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+            finally:
+                # also kill anything run_autograder left running in the
+                # background, which would otherwise write into the tree
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                p.wait()
+
+        elapsed = time.monotonic() - start
+
+        resultsfile = os.path.join(agd, "results", "results.json")
+        expectedfile = os.path.join(expecteddir, f"{name}.results.json")
+
+        if timed_out:
+            return name, elapsed, "TIMEOUT", []
+
+        if not os.path.exists(resultsfile):
+            return name, elapsed, "ERROR", ["no results.json produced"]
+
+        with open(resultsfile, "r") as f:
+            actual = json.load(f)
+
+        if update:
+            with open(expectedfile, "w") as f:
+                json.dump(normalize_results(actual), f, indent=4)
+
+            return name, elapsed, "UPDATED", []
+
+        if not os.path.exists(expectedfile):
+            shutil.copyfile(resultsfile, os.path.join(logdir, f"{name}.results.json"))
+            return name, elapsed, "NEW", []
+
+        with open(expectedfile, "r") as f:
+            expected = json.load(f)
+
+        diffs = diff_results(expected, actual)
+        if diffs:
+            shutil.copyfile(resultsfile, os.path.join(logdir, f"{name}.results.json"))
+
+        return name, elapsed, "DIFF" if diffs else "OK", diffs
+    finally:
+        if timed_out:
+            # don't reuse a tree that a killed run may have left in any
+            # state, the next submission extracts a new one
+            shutil.rmtree(nd)
+            nd = None
+
+        # always return the slot, or other workers wait for it forever
+        trees.put(nd)
+
+def run_batch(archive, subdir, expecteddir, logdir, jobs, timeout, update):
+    """Run all submissions in subdir through the autograder, jobs at a
+       time, comparing their results to NAME.results.json in expecteddir.
+
+       Returns True if all results were as expected."""
+
+    subs = find_submissions(subdir)
+    jobs = max(1, min(jobs, len(subs)))
+
+    # extract the autograder once per worker, and reuse it for each submission
+    trees = queue.Queue()
+    for i in range(jobs):
+        trees.put(create_autograder_tree(archive))
+
+    print(f"Running {len(subs)} submissions using {jobs} autograder trees, logs in {logdir}")
+
+    start = time.monotonic()
+    status = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+            futures = {ex.submit(run_submission, trees, archive, name, path, expecteddir,
+                                 logdir, timeout, update): name for name, path in subs}
+
+            for f in concurrent.futures.as_completed(futures):
+                try:
+                    name, elapsed, st, diffs = f.result()
+                except Exception as e:
+                    # e.g. the autograder tree could not be extracted
+                    name, elapsed, st, diffs = futures[f], 0, "ERROR", [str(e)]
+
+                status[st] = status.get(st, 0) + 1
+
+                print(f"{st:8s} {name} ({elapsed:.1f}s)")
+                for d in diffs:
+                    print(f"    {d}")
+    finally:
+        while not trees.empty():
+            nd = trees.get()
+            if nd is not None: shutil.rmtree(nd)
+
+    total = time.monotonic() - start
+    print(f"{len(subs)} submissions in {total:.1f}s: " + ", ".join(f"{v} {k}" for k, v in sorted(status.items())))
+
+    return all(k in ("OK", "UPDATED") for k in status)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Test autograder submission")
+    p.add_argument("archive", help="Autograder archive file")
+    p.add_argument("submission", help="Student submission (or, with -b, a directory of submissions)")
+    p.add_argument("--sm", dest="metadata", help="Submission metadata file")
+    p.add_argument("-b", dest="batch", action="store_true",
+                   help="Run all submissions (zip files or directories) in a directory non-interactively, and compare their results")
+    p.add_argument("-e", dest="expected", help="Directory containing NAME.results.json (and optionally NAME.metadata.json) for each submission NAME (default: the submission directory)")
+    p.add_argument("-j", dest="jobs", type=int, default=1, help="Number of submissions to run in parallel in batch mode")
+    p.add_argument("-t", dest="timeout", type=int, help="Timeout in seconds for each submission in batch mode")
+    p.add_argument("-u", dest="update", action="store_true", help="Update the expected results in batch mode")
+    p.add_argument("-l", dest="logdir", help="Directory for logs and unexpected results in batch mode (default: a temporary directory)")
+
+    args = p.parse_args()
+
+    if args.batch:
+        logdir = args.logdir or tempfile.mkdtemp(prefix="test_gs_ag-")
+        os.makedirs(logdir, exist_ok=True)
+
+        ok = run_batch(args.archive, args.submission, args.expected or args.submission,
+                       logdir, args.jobs, args.timeout, args.update)
+        sys.exit(0 if ok else 1)
+
+    nd = create_autograder_tree(args.archive)
+    print(nd)
+
+    agd = os.path.join(nd, "autograder")
+    set_submission(nd, args.submission, args.metadata)
+
     os.chdir(agd)
     os.environ["AGROOT"] = nd
     print(f"Switching to {agd} with AGROOT={nd}. Type `exit` to quit. Directory will be deleted when process exits.")
@@ -0,0 +1,83 @@
+#!/bin/bash
+#
+# update_assignment.sh
+#
+# Bring source/assignment up to date, without touching the network on
+# every grading run.
+#
+# - If source/upstream names a local directory (a local or offline
+#   test run, see build.sh), it is copied with rsync. If that fails,
+#   the assignment is updated as below.
+#
+# - Otherwise, if a revision is pinned (in source/assignment_rev, or
+#   $AGREV), it is checked out, fetching only if it is not available
+#   locally. build.sh pins the revision the autograder was built from,
+#   so Gradescope runs never fetch unless the pin changes.
+#
+# - Otherwise, the repository is pulled, but at most once every
+#   $AGUPDATE_TTL seconds (default 300), recorded in
+#   source/.assignment_stamp. Since the stamp is kept in the tree, this
+#   only helps trees that are reused across runs (e.g. a local
+#   autograder tree); fresh trees always pull.
+#
+# Fetches use $AGMIRROR (a local mirror, path or bundle) instead of the
+# repository's remote if it is set. Use -f to ignore the TTL.
+
+P=`dirname $0`
+A="$P/assignment"
+STAMP="$P/.assignment_stamp"
+TTL=${AGUPDATE_TTL:-300}
+
+FORCE=0
+if [ "$1" == "-f" ]; then
+	FORCE=1
+fi;
+
+if [ -f "$P/upstream" ] && [ -d "`cat $P/upstream`" ]; then
+	if rsync --exclude 'ssh' -a `cat $P/upstream`/ "$A/"; then
+		echo "ASSIGNMENT: copied from `cat $P/upstream`"
+		exit 0
+	fi;
+
+	echo "WARNING: could not copy `cat $P/upstream`, updating with git instead"
+fi;
+
+REV=$AGREV
+if [ -z "$REV" ] && [ -f "$P/assignment_rev" ]; then
+	REV=`cat "$P/assignment_rev"`
+fi;
+
+HEAD=`git -C "$A" rev-parse HEAD`
+
+if [ ! -z "$REV" ]; then
+	PINNED=`git -C "$A" rev-parse -q --verify "$REV^{commit}"`
+	if [ -z "$PINNED" ]; then
+		git -C "$A" fetch ${AGMIRROR:-origin} || echo "WARNING: could not fetch $REV"
+		git -C "$A" fetch ${AGMIRROR:-origin} "$REV" 2>/dev/null # e.g., a commit not on a branch
+		PINNED=`git -C "$A" rev-parse -q --verify "$REV^{commit}"`
+	fi;
+
+	if [ -z "$PINNED" ]; then
+		echo "WARNING: pinned revision $REV not found, using $HEAD"
+	elif [ "$PINNED" != "$HEAD" ]; then
+		git -C "$A" checkout -q "$PINNED"
+	fi;
+else
+	NOW=`date +%s`
+	LAST=0
+	if [ -f "$STAMP" ]; then
+		LAST=`stat -c %Y "$STAMP"`
+	fi;
+
+	if [ $FORCE -eq 1 ] || [ $((NOW - LAST)) -ge $TTL ]; then
+		# don't retry a failed pull until the TTL expires either
+		touch "$STAMP"
+		if [ ! -z "$AGMIRROR" ]; then
+			git -C "$A" pull --ff-only "$AGMIRROR" `git -C "$A" rev-parse --abbrev-ref HEAD`
+		else
+			git -C "$A" pull --ff-only
+		fi || echo "WARNING: could not update assignment, using $HEAD"
+	fi;
+fi;
+
+echo "ASSIGNMENT: `git -C "$A" rev-parse HEAD`"